@@ -1,17 +1,23 @@
 """FastAPI SMS webhook and analysis service (behavior preserved)."""
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse, HTMLResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timezone, timedelta
-from typing import List, Dict, Optional
+from typing import List, Deque, Dict, Optional, Tuple
 import asyncio
 from store import build_store_from_env
-import os, json, requests, logging
+from semantic_cache import SemanticCache
+from semantic_cache_jit import warmup as warmup_topk
+import os, logging, hashlib, threading, bisect, itertools, time
+from collections import OrderedDict, deque
+import httpx
+import numpy as np
+import orjson
 try:
-    from openai import AzureOpenAI
+    from openai import AsyncAzureOpenAI
     _HAS_AZURE_OPENAI = True
 except Exception:
-    AzureOpenAI = None
+    AsyncAzureOpenAI = None
     _HAS_AZURE_OPENAI = False
 
 logger = logging.getLogger("app_sms")
@@ -29,70 +35,140 @@ app.add_middleware(
 
 STORE = build_store_from_env()
 
-# In-memory inbox (fallback)
-INBOX: List[Dict] = []
-_next_id = 1
-_inbox_lock = asyncio.Lock()
+# In-memory inbox (fallback); ids are monotonic, so INBOX_IDS stays sorted for bisect.
+# Both deques share maxlen, so they evict in step and stay index-aligned.
+INBOX_MAX = max(1, int(os.getenv("INBOX_MAX", "10000")))
+INBOX: Deque[Dict] = deque(maxlen=INBOX_MAX)
+INBOX_IDS: Deque[int] = deque(maxlen=INBOX_MAX)
+# count().__next__ is atomic under the GIL, so id allocation needs no lock
+_next_id = itertools.count(1).__next__
+_background_tasks: set = set()
 
-# SSE subscribers
-_subscribers: List[asyncio.Queue] = []
+def _spawn(coro) -> None:
+    # Callers all run on the server loop; the shared _HTTP client is bound to it,
+    # so there is no second loop to hand work to
+    loop = asyncio.get_running_loop()
+    # Keep a strong reference until done so fire-and-forget tasks are not GC'd
+    task = loop.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-async def _broadcast(event: Dict) -> None:
+# SSE subscribers; a client that falls SSE_QUEUE_MAX events behind is dropped
+# (EventSource reconnects and the page re-fetches from its last id)
+SSE_QUEUE_MAX = int(os.getenv("SSE_QUEUE_MAX", "100"))
+_subscribers: set = set()
+
+async def _broadcast(event: Dict) -> None:
     dead = []
-    for q in list(_subscribers):
+    for q in _subscribers:
         try:
             q.put_nowait(event)
-        except Exception:
+        except asyncio.QueueFull:
             dead.append(q)
     for q in dead:
-        try:
-            _subscribers.remove(q)
-        except ValueError:
-            pass
+        _subscribers.discard(q)
 
 async def add_to_inbox(message: str, sender: Optional[str], receiver: Optional[str],
                        provider_message_id: Optional[str], received_at_iso: Optional[str],
-                       trigger_auto: bool = True):
-    global _next_id
+                       trigger_auto: bool = True):
     ts = None
     if received_at_iso:
         try:
             ts = datetime.fromisoformat(received_at_iso.replace("Z","+00:00")).isoformat()
         except Exception:
             ts = None
-    async with _inbox_lock:
-        row = {
-            "id": _next_id,
-            "message": message,
-            "sender": sender,
-            "receiver": receiver,
-            "provider_message_id": provider_message_id,
-            "received_at": ts or datetime.utcnow().isoformat(),
-        }
-        INBOX.append(row)
-        try:
-            if STORE is not None:
-                STORE.add_sms(_next_id, {
-                    "message": row["message"],
-                    "sender": row.get("sender"),
-                    "receiver": row.get("receiver"),
-                    "provider_message_id": row.get("provider_message_id"),
-                    "received_at": row.get("received_at"),
-                    "created_at": datetime.utcnow().isoformat(),
-                })
-        except Exception:
-            pass
-        _next_id += 1
-    try:
-        await _broadcast({"type": "sms", "id": row["id"]})
-    except Exception:
-        pass
+    now = _now_iso()
+    # No await between id allocation and append: runs atomically on the event loop
+    row = {
+        "id": _next_id(),
+        "message": message,
+        "sender": sender,
+        "receiver": receiver,
+        "provider_message_id": provider_message_id,
+        "received_at": ts or now,
+    }
+    INBOX.append(row)
+    INBOX_IDS.append(row["id"])
+    # Persist off the request path; subscribers are notified once the row is readable
+    _enqueue_sms_write(row, now)
     if trigger_auto:
         try:
-            _schedule_auto_analyze(message)
+            _schedule_auto_analyze(message, receiver)
         except Exception:
             pass
 
+# SMS writes are queued and flushed by a single drainer, up to STORE_WRITE_BATCH rows
+# per commit; under a burst everything queued behind the first row rides one transaction
+STORE_WRITE_BATCH = 64
+_STORE_WRITE_Q: Optional[asyncio.Queue] = None
+_store_writer: Optional[asyncio.Task] = None
+
+def _enqueue_sms_write(row: Dict, created_at: str) -> None:
+    if STORE is None:
+        _spawn(_broadcast({"type": "sms", "id": row["id"]}))
+        return
+    _ensure_store_writer()
+    _STORE_WRITE_Q.put_nowait((row["id"], {
+        "message": row["message"],
+        "sender": row.get("sender"),
+        "receiver": row.get("receiver"),
+        "provider_message_id": row.get("provider_message_id"),
+        "received_at": row.get("received_at"),
+        "created_at": created_at,
+    }))
+
+# A failed batch is retried with backoff, then row by row; only rows that were
+# written are broadcast, so listeners never fetch an id that is not in the store
+STORE_WRITE_RETRIES = 3
+STORE_WRITE_BACKOFF_S = 0.5
+
+def _ensure_store_writer() -> None:
+    global _STORE_WRITE_Q, _store_writer
+    if _store_writer is not None and not _store_writer.done():
+        return
+    loop = asyncio.get_running_loop()
+    if _STORE_WRITE_Q is None:
+        _STORE_WRITE_Q = asyncio.Queue()
+    elif getattr(_STORE_WRITE_Q, "_loop", None) not in (None, loop):
+        # The old writer's loop went away; carry its pending rows over to a queue
+        # bound to this loop instead of dropping them
+        old, _STORE_WRITE_Q = _STORE_WRITE_Q, asyncio.Queue()
+        while not old.empty():
+            _STORE_WRITE_Q.put_nowait(old.get_nowait())
+    _store_writer = loop.create_task(_drain_store_writes(_STORE_WRITE_Q))
+
+async def _write_sms_batch(batch: List[Tuple[int, Dict]]) -> List[int]:
+    """Persist ``batch``; returns the ids that were written."""
+    for attempt in range(STORE_WRITE_RETRIES):
+        try:
+            await asyncio.to_thread(STORE.add_sms_many, batch)
+            return [id_num for id_num, _ in batch]
+        except Exception:
+            logger.warning("SMS batch write failed (attempt %d/%d, %d rows)",
+                           attempt + 1, STORE_WRITE_RETRIES, len(batch), exc_info=True)
+            await asyncio.sleep(STORE_WRITE_BACKOFF_S * (2 ** attempt))
+    # Isolate the bad rows so one of them cannot hold back the rest
+    written = []
+    for item in batch:
+        try:
+            await asyncio.to_thread(STORE.add_sms_many, [item])
+            written.append(item[0])
+        except Exception:
+            logger.error("dropping SMS %s after repeated write failures", item[0], exc_info=True)
+    return written
+
+async def _drain_store_writes(q: asyncio.Queue) -> None:
+    while True:
+        batch = [await q.get()]
+        while len(batch) < STORE_WRITE_BATCH and not q.empty():
+            batch.append(q.get_nowait())
+        try:
+            for id_num in await _write_sms_batch(batch):
+                await _broadcast({"type": "sms", "id": id_num})
+        finally:
+            for _ in batch:
+                q.task_done()
+
 # ---- Auto analysis backend (lightweight, server-side) ----
 
 SEARCH_ENDPOINT   = os.getenv("SEARCH_ENDPOINT", "").rstrip("/")
@@ -113,49 +189,143 @@ INFOBIP_HOST   = (os.getenv("INFOBIP_API_HOST") or os.getenv("INFOBIP_API_BASE")
 INFOBIP_APIKEY = (os.getenv("INFOBIP_API_KEY") or "").strip()
 INFOBIP_SENDER = (os.getenv("INFOBIP_SENDER") or "InfoSMS").strip()
 
-def _now_iso():
+# Endpoint URLs and request headers are fixed for the life of the process
+_EMBED_URL = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_EMBED_DEPLOY}/embeddings?api-version={AOAI_API_EMBED_VERSION}"
+_CHAT_URL = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_CHAT_DEPLOY}/chat/completions?api-version={AOAI_API_VERSION}"
+_SEARCH_URL = f"{SEARCH_ENDPOINT}/indexes('{SEARCH_INDEX}')/docs/search.post.search?api-version=2024-07-01"
+_INFOBIP_BASE_URL = f"https://{INFOBIP_HOST}/"
+_INFOBIP_URL = f"https://{INFOBIP_HOST}/sms/2/text/advanced"
+_AOAI_HEADERS = {"Content-Type": "application/json", "api-key": AOAI_KEY}
+_SEARCH_HEADERS = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
+_INFOBIP_HEADERS = {
+    "Authorization": f"App {INFOBIP_APIKEY}",
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+}
+
+# Shared async HTTP client: keeps TCP/TLS connections to Azure/Infobip alive across calls
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=32),
+    timeout=30,
+)
+
+# Azure OpenAI SDK clients reuse the shared connection pool
+_EMBED_CLIENT = None
+_CHAT_CLIENT = None
+if _HAS_AZURE_OPENAI:
     try:
-        return datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
+        _EMBED_CLIENT = AsyncAzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY,
+                                         api_version=AOAI_API_EMBED_VERSION, http_client=_HTTP)
     except Exception:
-        return datetime.utcnow().isoformat()
+        _EMBED_CLIENT = None
+    try:
+        _CHAT_CLIENT = AsyncAzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY,
+                                        api_version=AOAI_API_VERSION, http_client=_HTTP)
+    except Exception:
+        _CHAT_CLIENT = None
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
 
-def _embed_texts(texts: List[str]) -> List[List[float]]:
-    if _HAS_AZURE_OPENAI:
+# In-process LRU of text -> embedding (exact-match hits skip the AOAI round-trip)
+# Vectors are kept as contiguous float32 arrays (~6 KB each vs ~50 KB as list[float])
+_EMBED_CACHE: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_EMBED_CACHE_MAX = 2048
+_embed_cache_lock = threading.Lock()
+
+def _embed_key(text: str) -> str:
+    # Model is part of the key so a deployment swap never returns stale vectors
+    return hashlib.sha256(f"{AOAI_EMBED_DEPLOY}|{text}".encode("utf-8")).hexdigest()
+
+def _embed_store_get_many(keys: List[str]) -> Dict[str, np.ndarray]:
+    # Blocking SQLite reads: callers run this in a worker thread, once per batch
+    found: Dict[str, np.ndarray] = {}
+    try:
+        if STORE is not None:
+            for key in keys:
+                vec = STORE.get_embedding(key)
+                if vec is not None:
+                    found[key] = np.asarray(vec, dtype=np.float32)
+    except Exception:
+        pass
+    return found
+
+def _embed_store_put(key: str, vec: np.ndarray) -> None:
+    try:
+        if STORE is not None:
+            STORE.put_embedding(key, vec, AOAI_EMBED_DEPLOY, len(vec))
+    except Exception:
+        pass
+
+# Fixed REST bodies are specialised once; only the variable fields are serialised per call
+_EMBED_BODY_TEMPLATE = b'{"input":%s}'
+
+async def _embed_texts_remote(texts: List[str]) -> List[List[float]]:
+    if _EMBED_CLIENT is not None:
         try:
-            client = AzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY, api_version=AOAI_API_EMBED_VERSION)
-            resp = client.embeddings.create(model=AOAI_EMBED_DEPLOY, input=texts)
+            resp = await _EMBED_CLIENT.embeddings.create(model=AOAI_EMBED_DEPLOY, input=texts)
             return [d.embedding for d in resp.data]
         except Exception:
             pass
-    url = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_EMBED_DEPLOY}/embeddings?api-version={AOAI_API_EMBED_VERSION}"
-    headers = {"Content-Type": "application/json", "api-key": AOAI_KEY}
-    r = requests.post(url, headers=headers, data=json.dumps({"input": texts}))
+    r = await _HTTP.post(_EMBED_URL, headers=_AOAI_HEADERS, content=_EMBED_BODY_TEMPLATE % orjson.dumps(texts))
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     return [d["embedding"] for d in data["data"]]
 
-def _hybrid_search(q_text: str, top=5, k=8, weight=1.2):
-    q_vec = _embed_texts([q_text])[0]
-    url = f"{SEARCH_ENDPOINT}/indexes('{SEARCH_INDEX}')/docs/search.post.search?api-version=2024-07-01"
-    headers = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
-    body = {
-        "search": q_text,
-        "vectorQueries": [{
-            "kind": "vector",
-            "vector": q_vec,
-            "fields": "vector",
-            "k": k,
-            "weight": weight
-        }],
-        "top": top,
-        "select": "id,title,operator,direction,process,error_code,root_cause,initial_actions,diag_steps,escalation",
-        "queryType": "semantic",
-        "semanticConfiguration": "kb-semcfg",
-        "vectorFilterMode": "preFilter"
-    }
-    r = requests.post(url, headers=headers, data=json.dumps(body))
+async def _embed_texts(texts: List[str]) -> List[np.ndarray]:
+    keys = [_embed_key(t) for t in texts]
+    out: List[Optional[np.ndarray]] = [None] * len(texts)
+    missing: Dict[str, List[int]] = {}
+    with _embed_cache_lock:
+        for i, key in enumerate(keys):
+            vec = _EMBED_CACHE.get(key)
+            if vec is not None:
+                _EMBED_CACHE.move_to_end(key)
+                out[i] = vec
+            else:
+                missing.setdefault(key, []).append(i)
+    if missing:
+        # Second tier: vectors persisted by earlier processes
+        stored = await asyncio.to_thread(_embed_store_get_many, list(missing)) if STORE is not None else {}
+        # Only unique misses of both tiers go to AOAI; duplicates in the batch share one result
+        miss_keys = [k for k in missing if k not in stored]
+        fetched: Dict[str, np.ndarray] = {}
+        if miss_keys:
+            vecs = await _embed_texts_remote([texts[missing[k][0]] for k in miss_keys])
+            fetched = {k: np.asarray(v, dtype=np.float32) for k, v in zip(miss_keys, vecs)}
+            for key, vec in fetched.items():
+                _embed_store_put(key, vec)
+        with _embed_cache_lock:
+            for key, vec in {**stored, **fetched}.items():
+                for i in missing[key]:
+                    out[i] = vec
+                _EMBED_CACHE[key] = vec
+                _EMBED_CACHE.move_to_end(key)
+            while len(_EMBED_CACHE) > _EMBED_CACHE_MAX:
+                _EMBED_CACHE.popitem(last=False)
+    return out
+
+_SEARCH_BODY_TEMPLATE = (
+    b'{"search":%s,"vectorQueries":[{"kind":"vector","vector":%s,"fields":"vector","k":%d,"weight":%s}],'
+    b'"top":%d,'
+    b'"select":"id,title,operator,direction,process,error_code,root_cause,initial_actions,diag_steps,escalation",'
+    b'"queryType":"semantic","semanticConfiguration":"kb-semcfg","vectorFilterMode":"preFilter"}'
+)
+
+async def _hybrid_search(q_text: str, top=5, k=8, weight=1.2, q_vec: Optional[np.ndarray] = None):
+    if q_vec is None:
+        q_vec = (await _embed_texts([q_text]))[0]
+    body = _SEARCH_BODY_TEMPLATE % (
+        orjson.dumps(q_text),
+        orjson.dumps(np.asarray(q_vec, dtype=np.float32), option=orjson.OPT_SERIALIZE_NUMPY),
+        int(k),
+        orjson.dumps(float(weight)),
+        int(top),
+    )
+    r = await _HTTP.post(_SEARCH_URL, headers=_SEARCH_HEADERS, content=body)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 SYSTEM_PROMPT = """KT 운영 메시지 자동 분석 시스템입니다.
 아래 포맷으로 간결히 답변하세요.
@@ -179,24 +349,26 @@ def _render_context_items(results, max_items=3):
         })
     return items
 
-def _chat_answer(sms_text: str, ctx_items: List[Dict]):
-    if _HAS_AZURE_OPENAI:
+_CHAT_BODY_TEMPLATE = (
+    b'{"messages":[{"role":"system","content":' + orjson.dumps(SYSTEM_PROMPT).replace(b"%", b"%%") + b'},'
+    b'{"role":"user","content":%s}],"temperature":0.2}'
+)
+
+async def _chat_answer(sms_text: str, ctx_items: List[Dict]):
+    if _CHAT_CLIENT is not None:
         try:
-            client = AzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY, api_version=AOAI_API_VERSION)
-            resp = client.chat.completions.create(
+            resp = await _CHAT_CLIENT.chat.completions.create(
                 model=AOAI_CHAT_DEPLOY,
-                messages=[{"role": "system", "content": SYSTEM_PROMPT},{"role":"user","content": json.dumps({"sms": sms_text, "top_kb": ctx_items}, ensure_ascii=False)}],
+                messages=[{"role": "system", "content": SYSTEM_PROMPT},{"role":"user","content": orjson.dumps({"sms": sms_text, "top_kb": ctx_items}).decode()}],
                 temperature=0.2,
             )
             return resp.choices[0].message.content
         except Exception:
             pass
-    url = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_CHAT_DEPLOY}/chat/completions?api-version={AOAI_API_VERSION}"
-    headers = {"Content-Type": "application/json", "api-key": AOAI_KEY}
-    payload = {"messages":[{"role":"system","content":SYSTEM_PROMPT},{"role":"user","content": json.dumps({"sms": sms_text, "top_kb": ctx_items}, ensure_ascii=False)}], "temperature":0.2}
-    r = requests.post(url, headers=headers, data=json.dumps(payload))
+    payload = _CHAT_BODY_TEMPLATE % orjson.dumps(orjson.dumps({"sms": sms_text, "top_kb": ctx_items}).decode())
+    r = await _HTTP.post(_CHAT_URL, headers=_AOAI_HEADERS, content=payload)
     r.raise_for_status()
-    return r.json()["choices"][0]["message"]["content"]
+    return orjson.loads(r.content)["choices"][0]["message"]["content"]
 
 def _truncate_utf8(s: str, max_bytes: int) -> str:
     try:
@@ -214,7 +386,7 @@ def _truncate_utf8(s: str, max_bytes: int) -> str:
     except Exception:
         return s[:max_bytes]
 
-def _ai_summarize_short(text: str, ctx_items: List[Dict], max_bytes: int = 180) -> Optional[str]:
+async def _ai_summarize_short(text: str, ctx_items: List[Dict], max_bytes: int = 180) -> Optional[str]:
     try:
         if not text:
             return None
@@ -224,9 +396,8 @@ def _ai_summarize_short(text: str, ctx_items: List[Dict], max_bytes: int = 180)
             f"UTF-8 기준 {max_bytes}바이트를 절대 넘기지 마세요.\n\n"
             f"답변 본문:\n{text}\n"
         )
-        if _HAS_AZURE_OPENAI and AOAI_ENDPOINT and AOAI_KEY and AOAI_API_VERSION:
-            client = AzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY, api_version=AOAI_API_VERSION)
-            resp = client.chat.completions.create(
+        if _CHAT_CLIENT is not None and AOAI_ENDPOINT and AOAI_KEY and AOAI_API_VERSION:
+            resp = await _CHAT_CLIENT.chat.completions.create(
                 model=AOAI_CHAT_DEPLOY,
                 messages=[
                     {"role":"system","content":"너는 운영 현장 담당자를 위한 초간결 알림 문장을 작성한다. 원인과 즉시 취할 조치 하나를 포함해 완전한 문장으로 답한다."},
@@ -242,10 +413,10 @@ def _ai_summarize_short(text: str, ctx_items: List[Dict], max_bytes: int = 180)
         return None
     return None
 
-def _build_summary_sms(answer_text: str, ctx_items: List[Dict], max_bytes: int = 180) -> str:
+async def _build_summary_sms(answer_text: str, ctx_items: List[Dict], max_bytes: int = 180) -> str:
     try:
         # Try AI-constrained summary first
-        ai = _ai_summarize_short(answer_text, ctx_items, max_bytes=max_bytes)
+        ai = await _ai_summarize_short(answer_text, ctx_items, max_bytes=max_bytes)
         if ai:
             return ai
         # Fallback: truncate original answer
@@ -256,50 +427,92 @@ def _build_summary_sms(answer_text: str, ctx_items: List[Dict], max_bytes: int =
     except Exception:
         return _truncate_utf8((answer_text or '').strip(), max_bytes)
 
-def _send_infobip_sms(to_msisdn: str, text: str) -> Optional[Dict]:
+_INFOBIP_BODY_TEMPLATE = (
+    b'{"messages":[{"destinations":[{"to":%s}],"from":' + orjson.dumps(INFOBIP_SENDER).replace(b"%", b"%%")
+    + b',"text":%s}]}'
+)
+
+async def _send_infobip_sms(to_msisdn: str, text: str) -> Optional[Dict]:
     to = (to_msisdn or "").strip()
     if not to or not INFOBIP_HOST or not INFOBIP_APIKEY:
         return None
-    url = f"https://{INFOBIP_HOST}/sms/2/text/advanced"
-    headers = {
-        "Authorization": f"App {INFOBIP_APIKEY}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
-    payload = {
-        "messages": [
-            {
-                "destinations": [{"to": to}],
-                "from": INFOBIP_SENDER,
-                "text": text,
-            }
-        ]
-    }
-    r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=10)
+    payload = _INFOBIP_BODY_TEMPLATE % (orjson.dumps(to), orjson.dumps(text))
+    r = await _HTTP.post(_INFOBIP_URL, headers=_INFOBIP_HEADERS, content=payload, timeout=10)
     try:
         r.raise_for_status()
-        return r.json()
+        return orjson.loads(r.content)
     except Exception:
         return None
 
-def _schedule_auto_analyze(message: str):
+async def _prepare_infobip_session() -> None:
+    """Open the pooled connection to Infobip once at startup (DNS + TLS handshake)."""
+    if not INFOBIP_HOST or not INFOBIP_APIKEY:
+        return
     try:
-        asyncio.get_event_loop().create_task(_auto_analyze(message))
-    except RuntimeError:
-        # In case no running loop (sync context), run in background thread
-        asyncio.run(_auto_analyze(message))
+        await _HTTP.head(_INFOBIP_BASE_URL, timeout=5)
+    except Exception:
+        pass
+
+def _schedule_auto_analyze(message: str, receiver: Optional[str] = None):
+    _spawn(_auto_analyze(message, receiver))
+
+def _schedule_auto_analyze_batch(items: List[Tuple[str, Optional[str]]]):
+    _spawn(_auto_analyze_batch(items))
+
+# Near-duplicate SMS (cosine >= threshold, same receiver) reuse the previous search + answer
+_ANSWER_CACHE = SemanticCache(
+    capacity=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.93")),
+    ttl_s=float(os.getenv("ANSWER_CACHE_TTL", "900")),
+    dtype=np.float16,
+)
 
-from typing import Optional
+# Exact repeats (same receiver + text within the window) skip the pipeline entirely.
+# Insertion order is arrival order, so expired digests are always at the front.
+_DEDUPE_TTL_S = float(os.getenv("SMS_DEDUPE_TTL", "60"))
+_RECENT_DIGESTS: Dict[str, Tuple[float, Optional[str]]] = {}
 
-def _auto_analyze_blocking(message: str) -> Optional[str]:
+def _sms_digest(text: str, receiver: Optional[str]) -> str:
+    return hashlib.sha1(f"{receiver or ''}|{text.strip().lower()}".encode("utf-8")).hexdigest()
+
+def _claim_digest(digest: str) -> bool:
+    """Return False when the same SMS was seen within the window; otherwise record it."""
+    now = time.monotonic()
+    while _RECENT_DIGESTS:
+        oldest = next(iter(_RECENT_DIGESTS))
+        if _RECENT_DIGESTS[oldest][0] >= now - _DEDUPE_TTL_S:
+            break
+        del _RECENT_DIGESTS[oldest]
+    if digest in _RECENT_DIGESTS:
+        return False
+    _RECENT_DIGESTS[digest] = (now, None)
+    return True
+
+async def _auto_analyze(message: str, receiver: Optional[str] = None,
+                        q_vec: Optional[np.ndarray] = None) -> Optional[str]:
+    text = (message or "").strip()
+    if not text:
+        return None
+    digest = _sms_digest(text, receiver)
+    if not _claim_digest(digest):
+        return _RECENT_DIGESTS[digest][1]
+    return await _run_analysis(text, receiver, digest, q_vec)
+
+async def _run_analysis(text: str, receiver: Optional[str], digest: str,
+                        q_vec: Optional[np.ndarray] = None) -> Optional[str]:
+    aid = None
     try:
-        text = (message or "").strip()
-        if not text:
-            return
         n = {"raw": text}
-        hits = _hybrid_search(text, top=5, k=8, weight=1.2)
-        ctx_items = _render_context_items(hits, max_items=3)
-        answer = _chat_answer(text, ctx_items)
+        if q_vec is None:
+            q_vec = (await _embed_texts([text]))[0]
+        cached = _ANSWER_CACHE.get(receiver or "", q_vec)
+        if cached is not None:
+            hits, ctx_items, answer = cached
+        else:
+            hits = await _hybrid_search(text, top=5, k=8, weight=1.2, q_vec=q_vec)
+            ctx_items = _render_context_items(hits, max_items=3)
+            answer = await _chat_answer(text, ctx_items)
+            _ANSWER_CACHE.put(receiver or "", q_vec, (hits, ctx_items, answer))
         rec_out = {
             "sms": text,
             "normalized": n,
@@ -308,52 +521,78 @@ def _auto_analyze_blocking(message: str) -> Optional[str]:
             "answer": answer,
             "ts": _now_iso(),
         }
-        aid: Optional[str] = None
-        try:
-            if STORE is not None:
-                aid = STORE.save_analysis(rec_out)
-        except Exception:
-            pass
-        try:
-            if _NOTIFY_MSISDN:
-                sms_text = _build_summary_sms(answer, ctx_items)
-                _send_infobip_sms(_NOTIFY_MSISDN, sms_text)
-        except Exception:
-            pass
-        return aid
+
+        async def _save_and_broadcast() -> None:
+            nonlocal aid
+            try:
+                if STORE is not None:
+                    aid = await asyncio.to_thread(STORE.save_analysis, rec_out)
+                    if aid:
+                        entry = _RECENT_DIGESTS.get(digest)
+                        if entry is not None:
+                            _RECENT_DIGESTS[digest] = (entry[0], aid)
+                        await _broadcast({"type": "analysis", "id": aid})
+            except Exception:
+                pass
+
+        async def _notify() -> None:
+            try:
+                if _NOTIFY_MSISDN:
+                    sms_text = await _build_summary_sms(answer, ctx_items)
+                    await _send_infobip_sms(_NOTIFY_MSISDN, sms_text)
+            except Exception:
+                pass
+
+        # Persist the record while the summary SMS is generated and sent
+        await asyncio.gather(_save_and_broadcast(), _notify())
     except Exception:
-        return None
+        # Let a retry of the same SMS through instead of deduping against a failure
+        _RECENT_DIGESTS.pop(digest, None)
+    return aid
 
-async def _auto_analyze(message: str) -> None:
+async def _auto_analyze_batch(items: List[Tuple[str, Optional[str]]]) -> None:
+    todo = []
+    for m, r in items:
+        text = (m or "").strip()
+        if text:
+            digest = _sms_digest(text, r)
+            if _claim_digest(digest):
+                todo.append((text, r, digest))
+    if not todo:
+        return
     try:
-        # Offload blocking network calls to a worker thread to avoid blocking the event loop
-        aid = await asyncio.to_thread(_auto_analyze_blocking, message)
-        try:
-            if aid:
-                await _broadcast({"type": "analysis", "id": aid})
-        except Exception:
-            pass
+        vecs: List[Optional[np.ndarray]] = await _embed_texts([t for t, _, _ in todo])
     except Exception:
-        pass
-
+        vecs = [None] * len(todo)
+    await asyncio.gather(*(_run_analysis(t, r, d, q_vec=v) for (t, r, d), v in zip(todo, vecs)))
+
 @app.post("/sms")
 async def inbound_sms(request: Request):
     ctype = (request.headers.get("content-type") or "").lower()
     if "application/json" in ctype:
-        body = await request.json()
-        events = body if isinstance(body, list) else [body]
+        body = orjson.loads(await request.body())
+        events = body if isinstance(body, list) else [body]
+        batch: List[Tuple[str, Optional[str]]] = []
         for e in events:
             results = e.get("results") if isinstance(e, dict) else None
             if results and isinstance(results, list):
                 for item in results:
+                    message = item.get("text") or item.get("message")
                     await add_to_inbox(
-                        message=item.get("text") or item.get("message"),
+                        message=message,
                         sender=item.get("from"),
                         receiver=item.get("to"),
                         provider_message_id=item.get("messageId"),
                         received_at_iso=item.get("receivedAt"),
-                        trigger_auto=True
+                        trigger_auto=False
                     )
+                    batch.append((message, item.get("to")))
+        if batch:
+            # One embeddings request for the whole webhook delivery, then per-SMS fan-out
+            try:
+                _schedule_auto_analyze_batch(batch)
+            except Exception:
+                pass
         return PlainTextResponse("OK")
     if "application/x-www-form-urlencoded" in ctype:
         form = await request.form()
@@ -387,41 +626,73 @@ async def root():
     )
     return HTMLResponse(content=html, status_code=200)
 
-@app.get("/api/sms/recent")
-async def get_recent(limit: int = 50, since_id: int = 0):
+def _ndjson_lines(items):
+    # Runs lazily after the response has started, so errors can only end the stream here
+    try:
+        for item in items:
+            yield orjson.dumps(item) + b"\n"
+    except Exception as e:
+        logger.warning("ndjson stream aborted: %s", e)
+
+@app.get("/api/sms/recent")
+async def get_recent(limit: int = 50, since_id: int = 0, format: str = "json"):
     if STORE is not None:
         try:
-            items = STORE.get_sms_recent(since_id=since_id, limit=min(int(limit), 500))
-            return JSONResponse(items)
+            if format == "ndjson":
+                # Rows are written as they are read instead of building the whole list first.
+                # The first batch is read here so a store failure still falls back below.
+                it = STORE.iter_sms_recent(since_id=since_id, limit=min(int(limit), 500))
+                first = await asyncio.to_thread(next, it, None)
+                items = itertools.chain(() if first is None else (first,), it)
+                return StreamingResponse(_ndjson_lines(items), media_type="application/x-ndjson")
+            items = await asyncio.to_thread(STORE.get_sms_recent, since_id=since_id, limit=min(int(limit), 500))
+            return ORJSONResponse(items)
         except Exception:
             pass
-    async with _inbox_lock:
-        rows = [x for x in INBOX if x["id"] > since_id]
-        rows = sorted(rows, key=lambda r: r["id"], reverse=True)[: min(limit, 500)]
-    return JSONResponse(rows)
+    # Newest-first tail after since_id: bisect the id deque, then read at most limit rows
+    cut = bisect.bisect_right(INBOX_IDS, since_id)
+    count = max(0, min(len(INBOX) - cut, min(limit, 500)))
+    rows = list(itertools.islice(reversed(INBOX), count))
+    if format == "ndjson":
+        return StreamingResponse(_ndjson_lines(rows), media_type="application/x-ndjson")
+    return ORJSONResponse(rows)
+
+@app.get("/api/state")
+async def get_state():
+    # Latest id a reader can actually fetch. With a store that is the committed max:
+    # INBOX runs ahead of it while writes are still queued in _drain_store_writes.
+    last_id = 0
+    if STORE is not None:
+        try:
+            last_id = await asyncio.to_thread(STORE.get_sms_max_id)
+        except Exception:
+            pass
+    elif INBOX_IDS:
+        last_id = INBOX_IDS[-1]
+    return ORJSONResponse({"last_id": int(last_id or 0)})
 
 @app.get("/api/sms/stream")
 async def sms_stream(request: Request):
     async def event_gen():
-        q: asyncio.Queue = asyncio.Queue()
-        _subscribers.append(q)
+        q: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_MAX)
+        _subscribers.add(q)
         try:
             yield "event: ping\ndata: connected\n\n"
-            while True:
+            while q in _subscribers:
                 if await request.is_disconnected():
                     break
                 try:
                     evt = await asyncio.wait_for(q.get(), timeout=30)
+                    # Coalesce a burst into one event carrying the latest id
+                    while not q.empty():
+                        evt = q.get_nowait()
                     sms_id = evt.get("id") if isinstance(evt, dict) else None
                     payload = str(sms_id) if sms_id is not None else "1"
                     yield f"event: sms\ndata: {payload}\n\n"
                 except asyncio.TimeoutError:
                     yield "event: ping\ndata: keep-alive\n\n"
         finally:
-            try:
-                _subscribers.remove(q)
-            except ValueError:
-                pass
+            _subscribers.discard(q)
     return StreamingResponse(event_gen(), media_type="text/event-stream", headers={
         "Cache-Control": "no-cache",
         "Connection": "keep-alive",
@@ -432,7 +703,7 @@ async def sms_stream(request: Request):
 # --- Notify recipient config API ---
 @app.get("/api/notify/config")
 async def get_notify_config():
-    return JSONResponse({
+    return ORJSONResponse({
         "recipient": _NOTIFY_MSISDN,
         "sender": INFOBIP_SENDER,
         "host": INFOBIP_HOST,
@@ -445,29 +716,49 @@ async def set_notify_config(request: Request):
         ctype = (request.headers.get("content-type") or "").lower()
         rec = None
         if "application/json" in ctype:
-            body = await request.json()
+            body = orjson.loads(await request.body())
             rec = (body or {}).get("recipient")
         else:
             form = await request.form()
             rec = form.get("recipient")
         global _NOTIFY_MSISDN
         _NOTIFY_MSISDN = (rec or "").strip()
-        return JSONResponse({"ok": True, "recipient": _NOTIFY_MSISDN})
+        return ORJSONResponse({"ok": True, "recipient": _NOTIFY_MSISDN})
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=400)
 
-async def _init_next_id_from_store() -> None:
+async def _init_next_id_from_store() -> None:
     global _next_id
     try:
         if STORE is not None:
             max_id = STORE.get_sms_max_id()
             if isinstance(max_id, int) and max_id >= 1:
-                _next_id = max_id + 1
+                _next_id = itertools.count(max_id + 1).__next__
     except Exception:
         pass
 
-import asyncio as _asyncio
-_asyncio.get_event_loop().create_task(_init_next_id_from_store())
+@app.on_event("startup")
+async def _startup() -> None:
+    await _init_next_id_from_store()
+    # Compile the answer-cache kernel now; otherwise the first lookup compiles on the loop
+    try:
+        await asyncio.to_thread(warmup_topk)
+    except Exception:
+        logger.warning("semantic cache warmup failed", exc_info=True)
+    if STORE is not None:
+        _ensure_store_writer()
+    _spawn(_prepare_infobip_session())
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    # Give queued SMS writes a chance to land before the process exits
+    if _STORE_WRITE_Q is not None and _store_writer is not None and not _store_writer.done():
+        try:
+            await asyncio.wait_for(_STORE_WRITE_Q.join(), timeout=5)
+        except Exception:
+            pass
+        _store_writer.cancel()
+    await _HTTP.aclose()
 
 # Runtime-configurable notify recipient (default from env)
 _NOTIFY_MSISDN = (os.getenv("NOTIFY_RECIPIENT") or "").strip()
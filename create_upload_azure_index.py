@@ -1,4 +1,7 @@
-import os, json, time, math, requests
+import os, json, time, math, asyncio, requests
+import httpx
+import orjson
+from tqdm import tqdm
 from dotenv import load_dotenv
 
 # ========== Load .env ==========
@@ -17,20 +20,24 @@ KB_JSON_PATH      = os.getenv("KB_JSON_PATH", "kb_playbook_sample_v2.json")
 # ---- 임베딩 차원: text-embedding-3-small = 1536, text-embedding-3-large = 3072 ----
 EMBEDDING_DIMS = 1536
 
+# ---- 엔드포인트 URL/헤더는 실행 중 바뀌지 않으므로 한 번만 생성 ----
+_INDEXES_URL      = f"{SEARCH_ENDPOINT}/indexes?api-version=2024-07-01"
+_INDEX_URL        = f"{SEARCH_ENDPOINT}/indexes/{INDEX_NAME}?api-version=2024-07-01"
+_INDEX_UPSERT_URL = f"{SEARCH_ENDPOINT}/indexes/{INDEX_NAME}/docs/index?api-version=2024-07-01"
+_EMBED_URL        = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_EMBED_DEPLOY}/embeddings?api-version={AOAI_API_VERSION}"
+_JSON_HEADERS     = {"Content-Type": "application/json"}
+_SEARCH_HEADERS   = {"Content-Type": "application/json", "api-key": SEARCH_ADMIN_KEY}
+_AOAI_HEADERS     = {"Content-Type": "application/json", "api-key": AOAI_KEY}
+
 # ========== Helpers ==========
 def _headers(admin=True):
-    h = {"Content-Type": "application/json"}
-    if admin:
-        h["api-key"] = SEARCH_ADMIN_KEY
-    return h
+    return _SEARCH_HEADERS if admin else _JSON_HEADERS
 
 def index_exists():
-    url = f"{SEARCH_ENDPOINT}/indexes/{INDEX_NAME}?api-version=2024-07-01"
-    r = requests.get(url, headers=_headers())
+    r = requests.get(_INDEX_URL, headers=_headers())
     return r.status_code == 200
 
 def create_index():
-    url = f"{SEARCH_ENDPOINT}/indexes?api-version=2024-07-01"
     body = {
         "name": INDEX_NAME,
         "fields": [
@@ -85,7 +92,7 @@ def create_index():
             "defaultConfiguration": "kb-semcfg"
         }
     }
-    r = requests.post(url, headers=_headers(), data=json.dumps(body))
+    r = requests.post(_INDEXES_URL, headers=_headers(), data=json.dumps(body))
     if r.status_code >= 300:
         raise RuntimeError(f"Create index failed: {r.status_code} {r.text}")
 
@@ -104,22 +111,71 @@ def ensure_index():
 import json as _json
 import urllib.parse as _url
 
-def embed_texts(texts):
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "8"))
+UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", "6"))
+MAX_RETRIES = 6
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+# Azure Search docs/index 한도: 요청당 1000건 또는 16MB 중 먼저 도달하는 쪽
+UPSERT_MAX_DOCS = 1000
+# 기본 배치는 작게 잡아 임베딩이 끝나는 대로 업서트가 출발하게 함 (1000건을 다 모을 때까지 기다리지 않음)
+UPSERT_BATCH_SIZE = min(UPSERT_MAX_DOCS, max(1, int(os.getenv("UPSERT_BATCH_SIZE", "200"))))
+UPSERT_MAX_BYTES = 16 * 1024 * 1024 - 64 * 1024  # {"value":[...]} 래핑 여유분
+
+async def _post_with_retry(client, url, headers, content):
+    """429/5xx와 연결 오류/타임아웃(httpx.TransportError)은 Retry-After 또는 지수 백오프로 재시도"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            r = await client.post(url, headers=headers, content=content)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(min(60.0, 2 ** attempt))
+            continue
+        if r.status_code in _RETRY_STATUS and attempt < MAX_RETRIES - 1:
+            try:
+                wait = float(r.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                wait = min(60.0, 2 ** attempt)
+            await asyncio.sleep(wait)
+            continue
+        return r
+
+async def embed_texts(client, texts, sem):
     """
     Azure OpenAI Embeddings REST (공식 SDK의 최신 버전 명칭이 변경될 수 있어 REST로 고정)
     """
-    url = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_EMBED_DEPLOY}/embeddings?api-version={AOAI_API_VERSION}"
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": AOAI_KEY
-    }
     payload = {"input": texts}
-    r = requests.post(url, headers=headers, data=_json.dumps(payload))
+    async with sem:
+        r = await _post_with_retry(client, _EMBED_URL, _AOAI_HEADERS, _json.dumps(payload))
     if r.status_code >= 300:
         raise RuntimeError(f"Embedding failed: {r.status_code} {r.text}")
     data = r.json()
     return [d["embedding"] for d in data["data"]]
 
+async def embed_docs(client, kb, chunk=64, concurrency=EMBED_CONCURRENCY):
+    """chunk 단위 임베딩을 동시에 요청하고, 끝나는 순서대로 업서트용 문서를 흘려보냄"""
+    sem = asyncio.Semaphore(concurrency)
+    total = len(kb)
+    bar = tqdm(total=total, desc="[EMBED]", unit="doc", mininterval=1.0)
+
+    async def run(i):
+        part = kb[i:i+chunk]
+        vecs = await embed_texts(client, [build_vector_source(d) for d in part], sem)
+        bar.update(len(part))
+        return [build_doc(d, v) for d, v in zip(part, vecs)]
+
+    tasks = [asyncio.create_task(run(i)) for i in range(0, total, chunk)]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            for doc in await fut:
+                yield doc
+    finally:
+        # 한 chunk가 실패하거나 소비자가 중단되면 남은 임베딩 요청을 취소
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        bar.close()
+
 def build_vector_source(doc):
     # 임베딩 품질/비용 밸런스: title + 핵심 필드 위주
     parts = [
@@ -130,17 +186,102 @@ def build_vector_source(doc):
     ]
     return " ".join([p for p in parts if p])
 
+def build_doc(d, v):
+    # 업서트용 문서 가공
+    return {
+        "@search.action": "mergeOrUpload",
+        "id": d["id"],
+        "title": d.get("title"),
+        "operator": d.get("operator", []),
+        "direction": d.get("direction"),
+        "process": d.get("process"),
+        "error_code": d.get("error_code"),
+        "symptoms": d.get("symptoms"),
+        "root_cause": d.get("root_cause"),
+        "initial_actions": d.get("initial_actions"),
+        "diag_steps": d.get("diag_steps"),
+        "escalation": d.get("escalation"),
+        "example_msgs": d.get("example_msgs"),
+        "vector": v
+    }
+
 # ---------- Upsert (batch) ----------
-def upsert_docs(docs, batch_size=100):
-    url = f"{SEARCH_ENDPOINT}/indexes/{INDEX_NAME}/docs/index?api-version=2024-07-01"
-    total = len(docs)
-    for i in range(0, total, batch_size):
-        batch = docs[i:i+batch_size]
-        payload = {"value": batch}
-        r = requests.post(url, headers=_headers(), data=json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+async def upsert_docs_async(docs, batch_size=UPSERT_BATCH_SIZE, concurrency=UPSERT_CONCURRENCY, client=None, total=None):
+    """
+    docs: list 또는 async iterable. batch_size개(최대 1000) 또는 16MB가 차는 즉시 업서트를 띄우고
+    동시에 진행되는 요청 수는 concurrency로 제한
+    total: 진행 표시용 전체 문서 수 (list면 생략 가능)
+    """
+    batch_size = max(1, min(batch_size, UPSERT_MAX_DOCS))
+    sem = asyncio.Semaphore(concurrency)
+    tasks = []
+    done = 0
+    if total is None and hasattr(docs, "__len__"):
+        total = len(docs)
+    bar = tqdm(total=total, desc="[UPSERT]", unit="doc", mininterval=1.0)
+
+    async def post(parts):
+        # 문서별로 이미 직렬화된 bytes를 이어 붙여 payload를 만듦 (str 경유 없이 한 번만 인코딩)
+        nonlocal done
+        body = b'{"value":[' + b",".join(parts) + b"]}"
+        async with sem:
+            r = await _post_with_retry(client, _INDEX_UPSERT_URL, _headers(), body)
         if r.status_code >= 300:
             raise RuntimeError(f"Upsert failed: {r.status_code} {r.text}")
-        print(f"[UPSERT] {i+1}..{min(i+batch_size,total)} / {total}")
+        done += len(parts)
+        bar.update(len(parts))
+
+    async def consume():
+        parts, size = [], 0
+
+        def flush():
+            # 이미 실패한 업서트가 있으면 남은 문서를 더 모으지 않고 바로 중단
+            for t in tasks:
+                if t.done() and t.exception() is not None:
+                    raise t.exception()
+            tasks.append(asyncio.create_task(post(parts)))
+
+        def add(doc):
+            nonlocal parts, size
+            b = orjson.dumps(doc)
+            if parts and (len(parts) >= batch_size or size + len(b) + 1 > UPSERT_MAX_BYTES):
+                flush()
+                parts, size = [], 0
+            parts.append(b)
+            size += len(b) + 1
+
+        try:
+            if hasattr(docs, "__aiter__"):
+                async for doc in docs:
+                    add(doc)
+            else:
+                for doc in docs:
+                    add(doc)
+            if parts:
+                flush()
+            await asyncio.gather(*tasks)
+        finally:
+            # 업서트 하나가 실패하면 나머지 업서트와 진행 중인 임베딩까지 정리
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if hasattr(docs, "aclose"):
+                await docs.aclose()
+        return done
+
+    try:
+        if client is not None:
+            return await consume()
+        async with httpx.AsyncClient(timeout=60) as client:
+            return await consume()
+    finally:
+        bar.close()
+
+async def index_kb(kb, chunk=64, batch_size=UPSERT_BATCH_SIZE):
+    # 임베딩이 끝난 chunk부터 바로 업서트 큐로 넘겨 임베딩 I/O와 업서트 I/O를 겹침
+    async with httpx.AsyncClient(timeout=60) as client:
+        return await upsert_docs_async(embed_docs(client, kb, chunk=chunk),
+                                       batch_size=batch_size, client=client, total=len(kb))
 
 def main():
     ensure_index()
@@ -153,37 +294,9 @@ def main():
 
     # 벡터 생성 (배치 임베딩 권장)
     # 긴 텍스트가 아니므로 한 번에 해도 무방하지만, 안전하게 64개 단위로 끊어서 호출
-    vec_texts = [build_vector_source(d) for d in kb]
-    vectors = []
-    chunk = 64
-    for i in range(0, len(vec_texts), chunk):
-        vecs = embed_texts(vec_texts[i:i+chunk])
-        vectors.extend(vecs)
-        print(f"[EMBED] {i+1}..{min(i+chunk,len(vec_texts))}/{len(vec_texts)}")
-
-    # 업서트용 문서 가공
-    docs = []
-    for d, v in zip(kb, vectors):
-        doc = {
-            "@search.action": "mergeOrUpload",
-            "id": d["id"],
-            "title": d.get("title"),
-            "operator": d.get("operator", []),
-            "direction": d.get("direction"),
-            "process": d.get("process"),
-            "error_code": d.get("error_code"),
-            "symptoms": d.get("symptoms"),
-            "root_cause": d.get("root_cause"),
-            "initial_actions": d.get("initial_actions"),
-            "diag_steps": d.get("diag_steps"),
-            "escalation": d.get("escalation"),
-            "example_msgs": d.get("example_msgs"),
-            "vector": v
-        }
-        docs.append(doc)
-
-    upsert_docs(docs, batch_size=100)
-    print("[DONE] Indexing complete.")
+    # 임베딩된 chunk는 곧바로 업서트 배치로 흘려보냄 (producer/consumer)
+    n = asyncio.run(index_kb(kb, chunk=64))
+    print(f"[DONE] Indexing complete. ({n} docs)")
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,17 @@
 ﻿# step3_rag_query.py
-import os, re, json, time, requests, math
+import os, re, time, requests, math, hashlib, threading, zlib, bisect, functools, logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-from store import build_store_from_env
+from store import build_store_from_env
+from semantic_cache import SemanticCache
 import streamlit as st
 from streamlit.components.v1 import html as st_html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 try:
     from openai import AzureOpenAI  # Azure OpenAI SDK client
     _HAS_AZURE_OPENAI = True
@@ -12,6 +19,8 @@ except Exception:
     AzureOpenAI = None
     _HAS_AZURE_OPENAI = False
 
+logger = logging.getLogger("query")
+
 # Load environment first so WEBHOOK_API_BASE is available
 load_dotenv()
 
@@ -19,9 +28,24 @@ load_dotenv()
 # Browser JS uses relative URLs; server-side Python (requests) needs absolute URL.
 _RAW_API_BASE = (os.getenv("WEBHOOK_API_BASE") or "").strip().rstrip("/")
 API_BASE = _RAW_API_BASE if _RAW_API_BASE else "http://127.0.0.1:8000"
-STORE = build_store_from_env()
+
+# rerun마다 스크립트가 다시 실행되므로 DB 연결은 프로세스당 한 번만 만들어 재사용.
+# 실패(None)는 캐시하지 않도록 예외로 올린다 — cache_resource는 예외를 캐시하지 않으므로 다음 rerun에서 다시 연다.
+@st.cache_resource(show_spinner=False)
+def get_store():
+    store = build_store_from_env()
+    if store is None:
+        raise RuntimeError("SQLite store unavailable")
+    return store
+
+try:
+    STORE = get_store()
+except RuntimeError:
+    STORE = None  # 이번 rerun은 메모리 모드로 동작
 
 # ---- Helpers ----
+# 같은 타임스탬프 문자열이 rerun마다 반복해서 들어오므로 순수 함수 결과를 메모이즈
+@functools.lru_cache(maxsize=4096)
 def fmt_recv_at(s: str) -> str:
     """Format ISO timestamps like 2025-09-15T01:33:47.645000+00:00 into a compact local string.
     - If looks like ISO with timezone, convert to KST (UTC+9) and format as 'YYYY-MM-DD HH:MM'
@@ -48,6 +72,7 @@ def now_iso_utc_z() -> str:
     except Exception:
         return time.strftime('%Y-%m-%d %H:%M:%S')
 
+@functools.lru_cache(maxsize=4096)
 def _parse_dt_safe(s: str):
     try:
         if not s:
@@ -63,6 +88,22 @@ def _parse_dt_safe(s: str):
         except Exception:
             return None
 
+# 정렬 키는 epoch 기준 정수 ns: datetime 비교보다 int 비교가 훨씬 싸다 (파싱 실패 시 맨 앞)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MIN_TS_NS = -(1 << 63)
+
+def _rec_ts_ns(rec):
+    dt = _parse_dt_safe(rec.get("received_at") if isinstance(rec, dict) else None)
+    return (dt - _EPOCH) // timedelta(microseconds=1) * 1000 if dt is not None else _MIN_TS_NS
+
+def _ts_key(rec):
+    # 이전 세션에서 넘어온 기록에는 _ts_ns가 없을 수 있으므로 처음 볼 때 채워 둔다
+    ts = rec.get("_ts_ns")
+    if ts is None:
+        rec.pop("_dt", None)
+        ts = rec["_ts_ns"] = _rec_ts_ns(rec)
+    return ts
+
 # ===== 환경변수 =====
 SEARCH_ENDPOINT   = os.environ["SEARCH_ENDPOINT"].rstrip("/")
 SEARCH_INDEX      = os.getenv("SEARCH_INDEX", "kb-playbook")
@@ -80,18 +121,71 @@ AOAI_CHAT_DEPLOY  = os.getenv("AOAI_DEPLOYMENT_CHAT",  "gpt-4.1-mini")
 
 EMBEDDING_DIMS    = int(os.getenv("EMBEDDING_DIMS", "1536"))  # text-embedding-3-small = 1536
 
-# Initialize Azure OpenAI SDK clients when available
-CHAT_CLIENT = None
-EMBED_CLIENT = None
-if _HAS_AZURE_OPENAI:
+# Initialize Azure OpenAI SDK clients when available (cached so reruns share their connection pools)
+@st.cache_resource(show_spinner=False)
+def get_chat_client():
+    if not _HAS_AZURE_OPENAI:
+        return None
     try:
-        CHAT_CLIENT = AzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY, api_version=AOAI_API_VERSION)
+        return AzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY, api_version=AOAI_API_VERSION, max_retries=5)
     except Exception:
-        CHAT_CLIENT = None
+        return None
+
+@st.cache_resource(show_spinner=False)
+def get_embed_client():
+    if not _HAS_AZURE_OPENAI:
+        return None
     try:
-        EMBED_CLIENT = AzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY, api_version=AOAI_API_EMBED_VERSION)
+        return AzureOpenAI(azure_endpoint=AOAI_ENDPOINT, api_key=AOAI_KEY, api_version=AOAI_API_EMBED_VERSION, max_retries=5)
     except Exception:
-        EMBED_CLIENT = None
+        return None
+
+CHAT_CLIENT = get_chat_client()
+EMBED_CLIENT = get_embed_client()
+
+# REST 폴백 경로의 URL/헤더는 모듈 로드 시 한 번만 구성 (본문은 orjson 바이트 그대로 전송)
+_EMBED_URL    = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_EMBED_DEPLOY}/embeddings?api-version={AOAI_API_EMBED_VERSION}"
+_CHAT_URL     = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_CHAT_DEPLOY}/chat/completions?api-version={AOAI_API_VERSION}"
+_AOAI_HEADERS = {"Content-Type": "application/json", "api-key": AOAI_KEY}
+
+# 공용 HTTP 세션: Azure Search / OpenAI(REST 폴백) / FastAPI 호출이 keep-alive 연결을 재사용.
+# 재시도(Retry-After 존중)는 어댑터가 처리한다.
+# 응답 압축은 세션 기본 Accept-Encoding(gzip, deflate; brotli 설치 시 br)으로 협상되고 자동 해제된다.
+def _make_session(retry):
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+# 멱등 호출 전용(GET, 검색/임베딩 POST): 429/5xx 재시도
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    return _make_session(Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    ))
+
+# 비멱등 POST(SMS 기록, 알림 설정 저장, 채팅 완성) 전용: 요청이 처리되지 않은 게 확실한
+# 연결 실패와 429만 재시도한다. 5xx/읽기 오류 재시도는 중복 저장·중복 과금을 만든다.
+@st.cache_resource(show_spinner=False)
+def _http_session_once():
+    return _make_session(Retry(
+        total=2,
+        connect=2,
+        read=0,
+        status=2,
+        backoff_factor=0.5,
+        status_forcelist=(429,),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ))
+
+_HTTP = _http_session()
+_HTTP_ONCE = _http_session_once()
 
 # ====== 정규식 & 파서 ======
 def rx(p):  # 미리 컴파일 + 대소문자 무시
@@ -122,12 +216,17 @@ OPERATOR_SYNONYMS = [
     (rx(r"MVNO|알뜰"), "MVNO"),
 ]
 ERROR_CODE_PAT = re.compile(r"\b([A-Z]{2}\d{4})\b", re.IGNORECASE)
-COUNT_PAT      = re.compile(r"(?:\uAC74\uC218)\\s*[:\\-]?\\s*(\\d+)")
-HOURS_PAT      = re.compile(r"(\\d+)\\s*(?:\\uC2DC\\uAC04)")
-MINS_PAT       = re.compile(r"(\\d+)\\s*(?:\\uBD84)")
-
+COUNT_PAT      = re.compile(r"건수\s*[:\-]?\s*(\d+)")
+HOURS_PAT      = re.compile(r"(\d+)\s*시간")
+MINS_PAT       = re.compile(r"(\d+)\s*분")
+# 이스케이프가 다시 깨지면 import 시점에 바로 실패하도록
+assert COUNT_PAT.search("건수:10").group(1) == "10"
+assert HOURS_PAT.search("최근 2시간").group(1) == "2"
+assert MINS_PAT.search("최근 10 분").group(1) == "10"
 
 
+# 카테고리별 패턴은 우선순위 순서대로 따로 search 한다. 하나의 교대식으로 합치면
+# CPython re에서는 각 패턴의 리터럴 접두 탐색 최적화가 사라져 오히려 1.5~3배 느렸다.
 def normalize_sms(text: str):
     t = text.strip()
     res = {
@@ -158,42 +257,115 @@ def normalize_sms(text: str):
     return res
 
 # ====== 임베딩 & 검색 ======
-def embed_texts(texts, retries=5, backoff=1.5):
-    # Prefer SDK (AzureOpenAI) when available; fallback to raw requests
-    last = None
-    for i in range(retries):
-        try:
-            if EMBED_CLIENT is not None:
-                try:
-                    resp = EMBED_CLIENT.embeddings.create(model=AOAI_EMBED_DEPLOY, input=texts)
-                    return [d.embedding for d in resp.data]
-                except Exception as e:
-                    msg = str(e)
-                    if "Error code: 404" in msg:
-                        raise RuntimeError(
-                            f"Azure OpenAI embedding deployment not found: AOAI_DEPLOYMENT_EMBED='{AOAI_EMBED_DEPLOY}'. "
-                            f"Check deployment name and AZURE_OPENAI_ENDPOINT. Raw: {msg}"
-                        )
-                    last = msg
-                    time.sleep(backoff * (i + 1)); continue
+# 임베딩 캐시: L1 = 텍스트 sha256 정확 일치(LRU), L2 = 문자 3-gram 스케치 코사인 근사 일치.
+# 임베딩은 API를 호출해야 얻을 수 있으므로 L2 조회에는 로컬에서 바로 만드는 스케치 벡터를 쓴다.
+# (건수/시각만 다른 같은 문구의 관제 SMS 폭주가 L2에 걸림)
+EMBED_CACHE_SIZE      = int(os.getenv("EMBED_CACHE_SIZE", "1024"))
+EMBED_CACHE_THRESHOLD = float(os.getenv("EMBED_CACHE_THRESHOLD", "0.97"))
+_SKETCH_DIMS = 2048
+
+@st.cache_resource(show_spinner=False)
+def _embed_cache():
+    # Streamlit은 매 rerun마다 스크립트를 다시 실행하므로 캐시는 resource로 유지
+    # 스케치 행렬은 float16으로 보관 (정규화는 SemanticCache.put에서 수행)
+    l2 = SemanticCache(capacity=EMBED_CACHE_SIZE, threshold=EMBED_CACHE_THRESHOLD, ttl_s=float("inf"),
+                       dtype=np.float16)
+    return threading.Lock(), OrderedDict(), l2
+
+# cache_resource 게터는 스크립트 스레드에서만 부른다(풀 스레드에는 ScriptRunContext가 없음).
+# rerun마다 같은 객체가 돌아오므로 모듈 전역에 묶어 두고 워커는 이 참조만 쓴다.
+_EMBED_CACHE = _embed_cache()
+
+def _text_sketch(text: str) -> np.ndarray:
+    t = " ".join(text.lower().split())
+    v = np.zeros(_SKETCH_DIMS, dtype=np.float32)
+    for i in range(max(1, len(t) - 2)):
+        v[zlib.crc32(t[i:i+3].encode("utf-8")) % _SKETCH_DIMS] += 1.0
+    return v
+
+def _embed_key(text: str) -> str:
+    # app_sms와 같은 키 규칙: 모델명을 키에 포함해 배포 교체 시 예전 벡터를 돌려주지 않음
+    return hashlib.sha256(f"{AOAI_EMBED_DEPLOY}|{text}".encode("utf-8")).hexdigest()
+
+def _embed_store_get(texts):
+    found = {}
+    if STORE is not None:
+        for t in texts:
+            try:
+                vec = STORE.get_embedding(_embed_key(t))
+            except Exception:
+                vec = None
+            if vec is not None:
+                found[t] = vec
+    return found
+
+def _embed_store_put(vecs):
+    if STORE is not None:
+        for t, vec in vecs.items():
+            try:
+                STORE.put_embedding(_embed_key(t), vec, AOAI_EMBED_DEPLOY, len(vec))
+            except Exception:
+                pass
+
+def embed_texts(texts):
+    # 조회 순서: L1(정확 일치) → L2(근사 일치) → SQLite(재시작/스케일아웃 후에도 유지) → Azure
+    lock, l1, l2 = _EMBED_CACHE
+    out = [None] * len(texts)
+    misses = {}
+    with lock:
+        for i, t in enumerate(texts):
+            key = _embed_key(t)
+            vec = l1.get(key)
+            if vec is not None:
+                l1.move_to_end(key)
+            else:
+                vec = l2.get("", _text_sketch(t))
+            if vec is not None:
+                out[i] = vec
             else:
-                url = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_EMBED_DEPLOY}/embeddings?api-version={AOAI_API_EMBED_VERSION}"
-                headers = {"Content-Type": "application/json", "api-key": AOAI_KEY}
-                payload = {"input": texts}
-                r = requests.post(url, headers=headers, data=json.dumps(payload))
-                if r.status_code == 200:
-                    data = r.json()
-                    return [d["embedding"] for d in data["data"]]
-                last = (r.status_code, r.text)
-                if r.status_code in (404, 429, 500, 502, 503, 504):
-                    time.sleep(backoff * (i + 1)); continue
-                break
+                misses.setdefault(t, []).append(i)
+    if misses:
+        found = _embed_store_get(misses)
+        remote = [t for t in misses if t not in found]
+        if remote:
+            fetched = dict(zip(remote, _embed_texts_remote(remote)))
+            _embed_store_put(fetched)
+            found.update(fetched)
+        with lock:
+            for t, vec in found.items():
+                l1[_embed_key(t)] = vec
+                while len(l1) > EMBED_CACHE_SIZE:
+                    l1.popitem(last=False)
+                l2.put("", _text_sketch(t), vec)
+                for i in misses[t]:
+                    out[i] = vec
+    return out
+
+def _embed_texts_remote(texts):
+    # Prefer SDK (AzureOpenAI) when available; fallback to raw requests.
+    # 재시도는 SDK(max_retries) / 세션 어댑터(Retry)가 담당
+    if EMBED_CLIENT is not None:
+        try:
+            resp = EMBED_CLIENT.embeddings.create(model=AOAI_EMBED_DEPLOY, input=texts)
+            return [d.embedding for d in resp.data]
         except Exception as e:
-            last = str(e)
-            time.sleep(backoff * (i + 1)); continue
-    raise RuntimeError(f"Embedding failed after retries: last={last}")
+            msg = str(e)
+            if "Error code: 404" in msg:
+                raise RuntimeError(
+                    f"Azure OpenAI embedding deployment not found: AOAI_DEPLOYMENT_EMBED='{AOAI_EMBED_DEPLOY}'. "
+                    f"Check deployment name and AZURE_OPENAI_ENDPOINT. Raw: {msg}"
+                )
+            raise RuntimeError(f"Embedding failed after retries: last={msg}")
+    payload = {"input": texts}
+    r = _HTTP.post(_EMBED_URL, headers=_AOAI_HEADERS, data=orjson.dumps(payload), timeout=30)
+    if r.status_code != 200:
+        raise RuntimeError(f"Embedding failed after retries: last={(r.status_code, r.text)}")
+    data = orjson.loads(r.content)
+    return [d["embedding"] for d in data["data"]]
 
 def build_filter(n):
+    if not (n.get("operator") or n.get("direction") or n.get("process") or n.get("error_code")):
+        return None
     fs = []
     if n.get("operator"):
         fs.append(f"operator/any(o: o eq '{n['operator']}')")
@@ -205,34 +377,109 @@ def build_filter(n):
         fs.append(f"(error_code eq '{n['error_code']}' or error_code eq 'ANY')")
     return " and ".join(fs) if fs else None
 
-def hybrid_search(n, top=5, k=8, weight=1.2):
+def search_text(n):
     tokens = [n.get("operator") or "", n.get("direction") or "", n.get("process") or "", n.get("error_code") or ""]
-    q_text = (" ".join([t for t in tokens if t]).strip() + " " + n["raw"]).strip()
-    q_vec  = embed_texts([q_text])[0]
-
-    url = f"{SEARCH_ENDPOINT}/indexes('{SEARCH_INDEX}')/docs/search.post.search?api-version=2024-07-01"
-    headers = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
-    body = {
-        "search": q_text,
-        "vectorQueries": [{
+    return (" ".join([t for t in tokens if t]).strip() + " " + n["raw"]).strip()
+
+# 임베딩이 이 시간 안에 오지 않으면 함께 띄워 둔 텍스트 전용 검색 결과를 쓴다
+EMBED_WAIT_S = float(os.getenv("EMBED_WAIT_S", "1.5"))
+# 폴백 텍스트 검색을 기다리는 상한 (요청 타임아웃 30초 + 재시도 여유)
+SEARCH_WAIT_S = float(os.getenv("SEARCH_WAIT_S", "60"))
+
+@st.cache_resource(show_spinner=False)
+def _search_pool():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="search")
+
+_SEARCH_POOL = _search_pool()  # hybrid_search는 분석 풀 스레드에서도 돌므로 전역 참조를 사용
+
+# 수신 조회는 검색 풀과 분리: 일괄 분석이 검색 풀을 느린 임베딩/검색 작업으로 채워도 rerun이 막히지 않도록
+@st.cache_resource(show_spinner=False)
+def _inbox_pool():
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="inbox")
+
+# 수신 조회 결과를 기다리는 상한 (요청 타임아웃 10초 + 재시도 여유)
+INBOX_WAIT_S = float(os.getenv("INBOX_WAIT_S", "20"))
+
+# 검색 요청의 고정 부분은 모듈 로드 시 한 번만 만들어 둠
+_SEARCH_URL     = f"{SEARCH_ENDPOINT}/indexes('{SEARCH_INDEX}')/docs/search.post.search?api-version=2024-07-01"
+_SEARCH_HEADERS = {"Content-Type": "application/json", "api-key": SEARCH_KEY}
+_SEARCH_SELECT  = "id,title,operator,direction,process,error_code,root_cause,initial_actions,diag_steps,escalation"
+_SEARCH_BODY_TEMPLATE = {
+    "select": _SEARCH_SELECT,
+    "queryType": "semantic",
+    "semanticConfiguration": "kb-semcfg",
+}
+_SEARCH_BODY_SIMPLE = {"select": _SEARCH_SELECT, "queryType": "simple"}
+
+def _post_search(n, q_text, top, vector_query=None, semantic=True):
+    body = {**(_SEARCH_BODY_TEMPLATE if semantic else _SEARCH_BODY_SIMPLE), "search": q_text, "top": top}
+    if vector_query is not None:
+        body["vectorQueries"] = [vector_query]
+        body["vectorFilterMode"] = "preFilter"
+    f = build_filter(n)
+    if f: body["filter"] = f
+    r = _HTTP.post(_SEARCH_URL, headers=_SEARCH_HEADERS, data=orjson.dumps(body), timeout=30)
+    if r.status_code >= 300:
+        raise RuntimeError(f"Search failed: {r.status_code} {r.text}")
+    return orjson.loads(r.content)
+
+# 검색 결과 캐시: 정규화 필드 + 원문(+검색 파라미터)이 같으면 임베딩/검색을 건너뜀 (TTL + LRU)
+SEARCH_CACHE_SIZE = 512
+SEARCH_CACHE_TTL  = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+
+@st.cache_resource(show_spinner=False)
+def _search_cache():
+    return threading.Lock(), OrderedDict()
+
+_SEARCH_CACHE = _search_cache()  # _EMBED_CACHE와 같은 이유로 전역에 묶어 둠
+
+def _search_key(n, top, k, weight):
+    key = {f: n.get(f) for f in ("operator", "direction", "process", "error_code")}
+    key.update(raw=n["raw"], top=top, k=k, weight=weight)
+    return hashlib.blake2b(orjson.dumps(key, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+def hybrid_search(n, top=5, k=8, weight=1.2, q_vec=None):
+    key = _search_key(n, top, k, weight)
+    lock, cache = _SEARCH_CACHE
+    with lock:
+        hit = cache.get(key)
+        if hit is not None:
+            if time.monotonic() - hit[0] < SEARCH_CACHE_TTL:
+                cache.move_to_end(key)
+                return hit[1]
+            del cache[key]
+    q_text = search_text(n)
+    res = None
+    if q_vec is None and n.get("error_code"):
+        # 에러코드 필터는 선택도가 높아 필터 + 키워드 검색만으로 충분한 경우가 대부분; 임베딩 호출 생략
+        res = _post_search(n, q_text, top, semantic=False)
+        if len(res.get("value", [])) < max(1, top / 2):
+            res = None  # 결과가 적으면 하이브리드로 재검색
+    if res is None and q_vec is None:
+        # 임베딩과 텍스트 전용 검색을 동시에 보낸다. 임베딩이 EMBED_WAIT_S 안에 오면 하이브리드로
+        # 승격하고 텍스트 결과는 버린다(이미 보낸 요청은 멈출 수 없어 비용은 그대로 든다).
+        pool = _SEARCH_POOL
+        fut_embed = pool.submit(embed_texts, [q_text])
+        fut_text = pool.submit(_post_search, n, q_text, top)
+        try:
+            q_vec = fut_embed.result(timeout=EMBED_WAIT_S)[0]
+        except Exception as e:
+            logger.warning("embedding unavailable (%r); falling back to text-only search", e)
+            return fut_text.result(timeout=SEARCH_WAIT_S)  # 텍스트 전용 결과는 캐시하지 않음
+    if res is None:
+        res = _post_search(n, q_text, top, {
             "kind": "vector",
             "vector": q_vec,
             "fields": "vector",
             "k": k,
             "weight": weight
-        }],
-        "top": top,
-        "select": "id,title,operator,direction,process,error_code,root_cause,initial_actions,diag_steps,escalation",
-        "queryType": "semantic",
-        "semanticConfiguration": "kb-semcfg",
-        "vectorFilterMode": "preFilter"
-    }
-    f = build_filter(n)
-    if f: body["filter"] = f
-    r = requests.post(url, headers=headers, data=json.dumps(body))
-    if r.status_code >= 300:
-        raise RuntimeError(f"Search failed: {r.status_code} {r.text}")
-    return r.json()
+        })
+    with lock:
+        cache[key] = (time.monotonic(), res)
+        cache.move_to_end(key)
+        while len(cache) > SEARCH_CACHE_SIZE:
+            cache.popitem(last=False)
+    return res
 
 SYSTEM_PROMPT = """너는 KT 고객운영팀의 관제/장애 대응 보조 분석가다.
 반드시 근거(KB id, title)를 포함하고, 과장하지 말고 모르는 것은 모른다고 답한다.
@@ -244,67 +491,189 @@ SYSTEM_PROMPT = """너는 KT 고객운영팀의 관제/장애 대응 보조 분
 [근거] KB-xxx - title (최대 3개)
 """
 
-def render_context_items(results, max_items=3):
+# 프롬프트 길이(prefill)를 줄이기 위한 KB 필드 길이 제한과 전체 문자 예산
+CONTEXT_FIELD_MAX   = int(os.getenv("CONTEXT_FIELD_MAX", "400"))
+CONTEXT_CHAR_BUDGET = int(os.getenv("CONTEXT_CHAR_BUDGET", "2400"))
+
+def _truncate(s, n):
+    return s[:n] if isinstance(s, str) else s
+
+def render_context_items(results, max_items=3, n=None):
+    # 에러코드가 잡힌 경우 필터가 진단 경로를 이미 좁혀 주므로 diag_steps는 보내지 않음
+    with_diag = not (n or {}).get("error_code")
     items = []
     for doc in results.get("value", [])[:max_items]:
-        items.append({
+        item = {
             "id": doc.get("id"),
             "title": doc.get("title"),
-            "root_cause": doc.get("root_cause"),
-            "initial_actions": doc.get("initial_actions"),
-            "diag_steps": doc.get("diag_steps"),
-            "escalation": doc.get("escalation")
-        })
+            "root_cause": _truncate(doc.get("root_cause"), CONTEXT_FIELD_MAX),
+            "initial_actions": _truncate(doc.get("initial_actions"), CONTEXT_FIELD_MAX),
+            "escalation": _truncate(doc.get("escalation"), CONTEXT_FIELD_MAX)
+        }
+        if with_diag:
+            item["diag_steps"] = _truncate(doc.get("diag_steps"), CONTEXT_FIELD_MAX)
+        items.append(item)
+    # 문자 수로 토큰 수를 근사해 예산을 넘으면 상위 2개만 사용
+    if len(items) > 2 and sum(len(str(v or "")) for it in items for v in it.values()) > CONTEXT_CHAR_BUDGET:
+        items = items[:2]
     return items
 
-def generate_answer(sms_text, n, search_json):
-    ctx_items = render_context_items(search_json, max_items=3)
+CHAT_MAX_TOKENS = int(os.getenv("CHAT_MAX_TOKENS", "600"))
+
+def _chat_messages(sms_text, n, search_json):
+    ctx_items = render_context_items(search_json, max_items=3, n=n)
     user_msg = {
         "sms": sms_text,
         "normalized": n,
         "top_kb": ctx_items
     }
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": orjson.dumps(user_msg).decode()}
+    ]
+    return messages, ctx_items
+
+def _chat_sdk(messages, stream=False):
+    try:
+        return CHAT_CLIENT.chat.completions.create(
+            model=AOAI_CHAT_DEPLOY,
+            messages=messages,
+            temperature=0.2,
+            max_tokens=CHAT_MAX_TOKENS,
+            stream=stream,
+        )
+    except Exception as e:
+        msg = str(e)
+        if "Error code: 404" in msg:
+            raise RuntimeError(
+                f"Azure OpenAI chat deployment not found: AOAI_DEPLOYMENT_CHAT='{AOAI_CHAT_DEPLOY}'. "
+                f"Check deployment name and AZURE_OPENAI_ENDPOINT. Raw: {msg}"
+            )
+        raise
+
+def _chat_rest(messages):
+    payload = {
+        "messages": messages,
+        "temperature": 0.2,
+        "max_tokens": CHAT_MAX_TOKENS
+    }
+    r = _HTTP_ONCE.post(_CHAT_URL, headers=_AOAI_HEADERS, data=orjson.dumps(payload), timeout=60)
+    if r.status_code >= 300:
+        hint = ""
+        if r.status_code == 404:
+            hint = (
+                f" | Hint: Azure OpenAI deployment not found. "
+                f"Check AOAI_DEPLOYMENT_CHAT='{AOAI_CHAT_DEPLOY}' and AZURE_OPENAI_ENDPOINT='{AOAI_ENDPOINT}'."
+            )
+        raise RuntimeError(f"Chat failed: {r.status_code} {r.text}{hint}")
+    return orjson.loads(r.content)["choices"][0]["message"]["content"]
+
+def generate_answer(sms_text, n, search_json):
+    """(응답 텍스트, ctx_items) 반환. 백그라운드 분석용: 완성본만 저장하므로 스트리밍하지 않는다."""
+    messages, ctx_items = _chat_messages(sms_text, n, search_json)
     if CHAT_CLIENT is not None:
+        return _chat_sdk(messages).choices[0].message.content, ctx_items
+    return _chat_rest(messages), ctx_items
+
+def generate_answer_stream(sms_text, n, search_json):
+    """(응답 조각 generator, ctx_items) 반환. 화면에 바로 흘려 쓰는 단건 분석용으로 SDK가 있으면
+    토큰 단위 스트리밍, REST 폴백은 완성된 응답을 한 조각으로 내보낸다."""
+    messages, ctx_items = _chat_messages(sms_text, n, search_json)
+    if CHAT_CLIENT is None:
+        return iter([_chat_rest(messages)]), ctx_items
+    stream = _chat_sdk(messages, stream=True)
+
+    def deltas():
+        for chunk in stream:
+            # Azure는 첫 청크로 choices가 빈 content filter 결과를 보낼 수 있음
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+    return deltas(), ctx_items
+
+def analysis_record(sms_text, n, hits, ctx_items, answer):
+    return {
+        "sms": sms_text,
+        "normalized": n,
+        "hits": hits,
+        "context": ctx_items,
+        "answer": answer,
+        "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+def analyze_sms(sms_text, n=None, q_vec=None):
+    """정규화 → 검색 → 응답 생성 후 이력 레코드를 만들어 반환"""
+    n = n or normalize_sms(sms_text)
+    hits = hybrid_search(n, top=5, k=8, weight=1.3, q_vec=q_vec)
+    answer, ctx_items = generate_answer(sms_text, n, hits)
+    return analysis_record(sms_text, n, hits, ctx_items, answer)
+
+def save_analysis(rec_out):
+    if STORE is not None:
+        STORE.save_analysis(rec_out)
+    else:
+        st.session_state.analysis_history.insert(0, rec_out)
+
+EMBED_BATCH_MAX = 2048  # Azure OpenAI embeddings: 요청당 최대 입력 수
+
+def bulk_analyze(records):
+    """여러 SMS를 한 번에 분석: 정규화 후 임베딩을 배치 요청 한 번(2048개 단위)으로 묶는다"""
+    texts = [(r.get("message") if isinstance(r, dict) else str(r)) for r in records]
+    texts = [t for t in texts if t and t.strip()]
+    norms = [normalize_sms(t) for t in texts]
+    q_texts = [search_text(n) for n in norms]
+    q_vecs = []
+    for i in range(0, len(q_texts), EMBED_BATCH_MAX):
+        q_vecs.extend(embed_texts(q_texts[i:i+EMBED_BATCH_MAX]))
+    # 백그라운드 스레드에서 실행되므로 저장(session_state 접근 가능)은 호출 측에서 수행
+    return [analyze_sms(t, n=n, q_vec=v) for t, n, v in zip(texts, norms, q_vecs)]
+
+# 분석은 백그라운드 풀에서 돌리고, 대기 중인 분석이 있을 때만 fragment가 1초마다 진행 상황을 확인
+@st.cache_resource(show_spinner=False)
+def _analysis_pool():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="analyze")
+
+def submit_analysis(label, fn, *args):
+    pending = st.session_state.setdefault("pending_analyses", {})
+    pending[time.time_ns()] = (_analysis_pool().submit(fn, *args), label)
+
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+def _render_analysis_status():
+    pending = st.session_state.get("pending_analyses") or {}
+    done = [k for k, (fut, _) in pending.items() if fut.done()]
+    saved = 0
+    for k in done:
+        fut, label = pending.pop(k)
         try:
-            resp = CHAT_CLIENT.chat.completions.create(
-                model=AOAI_CHAT_DEPLOY,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": json.dumps(user_msg, ensure_ascii=False)}
-                ],
-                temperature=0.2,
-            )
-            return resp.choices[0].message.content, ctx_items
+            res = fut.result(timeout=0)  # done()인 것만 꺼내므로 기다리지 않음
+            for rec_out in (res if isinstance(res, list) else [res]):
+                save_analysis(rec_out)
+                saved += 1
         except Exception as e:
-            msg = str(e)
-            if "Error code: 404" in msg:
-                raise RuntimeError(
-                    f"Azure OpenAI chat deployment not found: AOAI_DEPLOYMENT_CHAT='{AOAI_CHAT_DEPLOY}'. "
-                    f"Check deployment name and AZURE_OPENAI_ENDPOINT. Raw: {msg}"
-                )
-            raise
-    else:
-        url = f"{AOAI_ENDPOINT}/openai/deployments/{AOAI_CHAT_DEPLOY}/chat/completions?api-version={AOAI_API_VERSION}"
-        headers = {"Content-Type": "application/json", "api-key": AOAI_KEY}
-        payload = {
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": json.dumps(user_msg, ensure_ascii=False)}
-            ],
-            "temperature": 0.2
-        }
-        r = requests.post(url, headers=headers, data=json.dumps(payload))
-        if r.status_code >= 300:
-            hint = ""
-            if r.status_code == 404:
-                hint = (
-                    f" | Hint: Azure OpenAI deployment not found. "
-                    f"Check AOAI_DEPLOYMENT_CHAT='{AOAI_CHAT_DEPLOY}' and AZURE_OPENAI_ENDPOINT='{AOAI_ENDPOINT}'."
-                )
-            raise RuntimeError(f"Chat failed: {r.status_code} {r.text}{hint}")
-        return r.json()["choices"][0]["message"]["content"], ctx_items
+            st.session_state["analysis_error_msg"] = f"분석 오류({label}): {e}"
+    for _, label in pending.values():
+        st.caption(f"⏳ 분석 중: {label}")
+    if done:
+        if saved:
+            st.session_state["analysis_success_msg"] = f"{saved}건 분석 완료! 아래 이력에서 확인하세요."
+        st.rerun()  # 이력 목록까지 새로 그리도록 전체 rerun
 
+_analysis_status_live = _fragment(run_every=1.0)(_render_analysis_status)
 
+def analysis_status():
+    # run_every 타이머는 대기 중인 분석이 있을 때만 건다. 마지막 분석이 끝나면 전체 rerun이
+    # 일어나고, 그 rerun에서는 타이머 없는 일반 호출로 바뀐다.
+    if st.session_state.get("pending_analyses"):
+        _analysis_status_live()
+    else:
+        _render_analysis_status()
+
+# 수신자 설정은 거의 바뀌지 않으므로 rerun마다 조회하지 않고 짧게 캐시 (저장 시 무효화)
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_notify_config(base):
+    r = _HTTP.get(f"{base}/api/notify/config", timeout=10)
+    r.raise_for_status()  # 실패는 캐시하지 않음
+    return (orjson.loads(r.content).get("recipient") or "").strip()
 
 def pull_from_inbox():
     """FastAPI INBOX에서 새 메시지를 가져와 sms_records에 추가"""
@@ -312,9 +681,15 @@ def pull_from_inbox():
         base = (API_BASE or "").rstrip("/")
         url = f"{base}/api/sms/recent?since_id={st.session_state.get('last_seen_id', 0)}&limit=100"
         # params = {"since_id": int(st.session_state.get("last_seen_id", 0) or 0), "limit": 100}
-        r = requests.get(url, timeout=10)
+        # 수신 조회를 풀에 띄워 두고, 그동안 (캐시가 만료됐다면) 수신자 설정을 갱신해 사이드바가 따로 기다리지 않도록 함
+        fut = _inbox_pool().submit(_HTTP.get, url, timeout=10)
+        try:
+            fetch_notify_config(base or "http://127.0.0.1:8000")
+        except Exception:
+            pass
+        r = fut.result(timeout=INBOX_WAIT_S)
         r.raise_for_status()
-        data = r.json()
+        data = orjson.loads(r.content)
         if not isinstance(data, list):
             return 0
         # 최신 id 갱신 & 메시지 추가(오래된 것부터 append)
@@ -322,10 +697,13 @@ def pull_from_inbox():
             txt = row.get("message") or ""
             if txt.strip():
                 recv_at = row.get("received_at") or now_iso_utc_z()
-                st.session_state.sms_records.append({
+                rec = {
                     "message": txt.strip(),
                     "received_at": recv_at,
-                })
+                }
+                # 수신 시각은 한 번만 파싱해 두고, 목록은 삽입 시점에 정렬 상태를 유지
+                rec["_ts_ns"] = _rec_ts_ns(rec)
+                bisect.insort(st.session_state.sms_records, rec, key=_ts_key)
             st.session_state["last_seen_id"] = max(
                 st.session_state.get("last_seen_id", 0), int(row.get("id", 0))
             )
@@ -363,49 +741,39 @@ if "last_seen_id" not in st.session_state:
 # --- SMS: 기록 & 입력 ---
 st.subheader("SMS 기록")
 
-pull_from_inbox()
-
-# Keep chronological order: older -> newer (newest at bottom)
+# Keep chronological order: older -> newer (newest at bottom).
+# pull_from_inbox inserts in order; only records from an older session need a one-off sort,
+# and it must happen first so insort sees a list that is already sorted.
 try:
-    st.session_state.sms_records = sorted(
-        st.session_state.sms_records,
-        key=lambda r: _parse_dt_safe(r.get("received_at") if isinstance(r, dict) else None) or datetime.min.replace(tzinfo=timezone.utc)
-    )
+    if any("_ts_ns" not in r for r in st.session_state.sms_records):
+        st.session_state.sms_records.sort(key=_ts_key)
 except Exception:
     pass
 
-# SSE 리스너: 서버에 새 SMS가 오면 자동 새로고침(재연결 + 폴백 폴링)
-try:
-    last_id = int(st.session_state.get("last_seen_id", 0) or 0)
-    # 폴링 간격 확보
-    try:
-        _default_poll_ms = int(os.getenv('POLL_INTERVAL_MS', '5000'))
-    except Exception:
-        _default_poll_ms = 5000
-    poll_ms = int(st.session_state.get('poll_interval_ms', _default_poll_ms))
-
-    # 중요: 브라우저는 same-origin으로만 접근해야 하므로 절대 URL 대신 경로만 사용
-    sse_url = "/api/sms/stream"
-    poll_url = f"/api/sms/recent?limit=1&since_id={last_id}"
+pull_from_inbox()
 
-    script = """
+# SSE 리스너: 서버에 새 SMS가 오면 자동 새로고침(재연결 + 폴백 폴링)
+# 스크립트 본문은 상수로 두고 설정값만 JSON으로 주입; 같은 poll_ms면 재생성하지 않음
+_JS_TEMPLATE = """
             <script>
             (function() {
-                var pollIntervalMs = %POLL_MS%;
-                var base = '%BASE%';
-                var sinceId = %SINCE_ID%;
-                var sseUrl = '%SSE_URL%';
-                var pollUrl = '%POLL_URL%';
+                var cfg = %(cfg)s;
+                var pollIntervalMs = cfg.pollMs;
+                var sseUrl = cfg.sseUrl;
+                var pollUrl = cfg.pollUrl;
+                // 이 세션이 마지막으로 가져온 id부터 폴링해야 사이에 도착한 SMS를 놓치지 않음
+                var sinceId = cfg.sinceId;
+                var fetchOpts = {
+                    cache: 'no-store', mode: 'cors', credentials: 'omit',
+                    headers: { 'Accept': 'application/json', 'ngrok-skip-browser-warning': 'true' }
+                };
                 function reloadPage() {
                     try { if (window && window.top) { window.top.location.reload(); } else { window.location.reload(); } }
                     catch(e) { window.location.reload(); }
                 }
                 function startPolling(){
                     setInterval(function() {
-                        fetch(pollUrl, {
-                            cache: 'no-store', mode: 'cors', credentials: 'omit',
-                            headers: { 'Accept': 'application/json', 'ngrok-skip-browser-warning': 'true' }
-                        })
+                        fetch(pollUrl + sinceId, fetchOpts)
                         .then(function(r){
                             if (!r.ok) return [];
                             var ct = (r.headers.get('content-type') || '').toLowerCase();
@@ -433,11 +801,30 @@ try:
                 }
             })();
             </script>
-    """.replace("%POLL_MS%", str(poll_ms)) \
-       .replace("%SINCE_ID%", str(last_id)) \
-       .replace("%SSE_URL%", sse_url) \
-       .replace("%POLL_URL%", poll_url)
-    st_html(script, height=0)
+"""
+
+@st.cache_data(show_spinner=False)
+def _sse_script(poll_ms, since_id):
+    # 중요: 브라우저는 same-origin으로만 접근해야 하므로 절대 URL 대신 경로만 사용
+    cfg = {
+        "pollMs": int(poll_ms),
+        "sinceId": int(since_id),
+        "sseUrl": "/api/sms/stream",
+        "pollUrl": "/api/sms/recent?limit=1&since_id=",
+    }
+    return _JS_TEMPLATE % {"cfg": orjson.dumps(cfg).decode()}
+
+# 본문이 rerun마다 동일해야 Streamlit이 iframe을 다시 만들지 않고 EventSource 연결이 유지됨.
+# 기준 id(last_seen_id)는 새 SMS를 가져올 때만 바뀌고, 그때는 어차피 페이지가 새로 그려진다.
+# (세션당 한 번만 그리면 다음 rerun에서 요소가 빠지면서 iframe이 제거되므로 매번 같은 값을 그린다)
+try:
+    # 폴링 간격 확보
+    try:
+        _default_poll_ms = int(os.getenv('POLL_INTERVAL_MS', '5000'))
+    except Exception:
+        _default_poll_ms = 5000
+    poll_ms = int(st.session_state.get('poll_interval_ms', _default_poll_ms))
+    st_html(_sse_script(poll_ms, int(st.session_state.get('last_seen_id', 0) or 0)), height=0)
 except Exception:
     pass
 
@@ -463,7 +850,7 @@ with st.sidebar:
 
 with st.container(border=True):
     # 최근 기록 10개 표시 + 개별 분석 버튼
-    for i, rec in enumerate(sorted(st.session_state.sms_records, key=lambda r: _parse_dt_safe(r.get("received_at") if isinstance(r, dict) else None) or datetime.min.replace(tzinfo=timezone.utc))[-10:], 1):
+    for i, rec in enumerate(st.session_state.sms_records[-10:], 1):
         cols = st.columns([8, 1])
         with cols[0]:
             with st.chat_message("user"):
@@ -473,23 +860,16 @@ with st.container(border=True):
         with cols[1]:
             if st.button("분석", key=f"analyze_{i}"):
                 target_sms = (rec.get("message") if isinstance(rec, dict) else str(rec))
+                # 단건은 응답을 생성되는 대로 메시지 열에 흘려 쓰고, 끝나면 이력에 저장 (일괄 분석만 백그라운드)
                 try:
-                    with st.spinner("정규화/검색/응답 생성 중..."):
+                    with st.spinner("정규화/검색 중..."):
                         n = normalize_sms(target_sms)
                         hits = hybrid_search(n, top=5, k=8, weight=1.3)
-                        answer, ctx_items = generate_answer(target_sms, n, hits)
-                    rec_out = {
-                        "sms": target_sms,
-                        "normalized": n,
-                        "hits": hits,
-                        "context": ctx_items,
-                        "answer": answer,
-                        "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    }
-                    if STORE is not None:
-                        STORE.save_analysis(rec_out)
-                    else:
-                        st.session_state.analysis_history.insert(0, rec_out)
+                    stream, ctx_items = generate_answer_stream(target_sms, n, hits)
+                    with cols[0]:
+                        with st.chat_message("assistant"):
+                            answer = st.write_stream(stream)
+                    save_analysis(analysis_record(target_sms, n, hits, ctx_items, answer))
                     st.session_state["analysis_success_msg"] = "분석 완료! 아래 이력에서 확인하세요."
                 except Exception as e:
                     st.error(f"분석 오류: {e}")
@@ -499,6 +879,12 @@ with st.container(border=True):
     cols = st.columns([1, 1, 6])
     with cols[0]:
         add_btn = st.button("기록 추가")
+    with cols[1]:
+        bulk_btn = st.button("전체 분석", help="최근 기록 10개를 한 번에 분석 (임베딩 배치 요청)")
+
+    if bulk_btn:
+        recent = list(st.session_state.sms_records[-10:])
+        submit_analysis(f"최근 {len(recent)}건 일괄 분석", bulk_analyze, recent)
 
     if add_btn and new_sms.strip():
         # Persist via backend instead of only session_state to survive full reloads
@@ -508,7 +894,7 @@ with st.container(border=True):
         try:
             base = (API_BASE or "").rstrip("/")
             payload = { 'text': new_sms.strip(), 'receivedAt': now_iso_utc_z() }
-            requests.post(f"{base}/sms", data=payload, timeout=10)
+            _HTTP_ONCE.post(f"{base}/sms", data=payload, timeout=10)
         except Exception:
             pass
         # Trigger immediate UI refresh in-session
@@ -517,6 +903,9 @@ with st.container(border=True):
         except Exception:
             pass
 
+    analysis_status()
+    if st.session_state.get("analysis_error_msg"):
+        st.error(st.session_state.pop("analysis_error_msg"))
     if st.session_state.get("analysis_success_msg"):
         st.success(st.session_state.analysis_success_msg)
 
@@ -524,20 +913,17 @@ with st.sidebar:
     st.markdown("---")
     st.markdown("### SMS (Infobip)")
     try:
-        _sbase = (API_BASE or "http://127.0.0.1:8000").rstrip("/")
-        conf = requests.get(f"{_sbase}/api/notify/config", timeout=10)
-        cur_rec = ""
-        if conf.ok:
-            j = conf.json()
-            cur_rec = (j.get("recipient") or "").strip()
+        _sbase = (API_BASE or "http://127.0.0.1:8000").rstrip("/")
+        cur_rec = fetch_notify_config(_sbase)
     except Exception:
         cur_rec = ""
     new_rec = st.text_input("수신자", cur_rec, help="e.g., 821011122233")
     if st.button("저장"):
         try:
             _sbase = (API_BASE or "http://127.0.0.1:8000").rstrip("/")
-            r = requests.post(f"{_sbase}/api/notify/config", data={"recipient": new_rec.strip()}, timeout=10)
-            if r.ok:
+            r = _HTTP_ONCE.post(f"{_sbase}/api/notify/config", data={"recipient": new_rec.strip()}, timeout=10)
+            if r.ok:
+                fetch_notify_config.clear()
                 st.success("저장 완료")
             else:
                 st.error(f"저장 실패: {r.text[:200]}")
@@ -550,9 +936,22 @@ if STORE is not None:
     st.subheader("분석 이력")
     if "history_page" not in st.session_state:
         st.session_state.history_page = 1
-    items, total = STORE.get_analysis_page(st.session_state.history_page, page_size)
+    total = STORE.count_analysis()
     total_pages = max(1, (total + page_size - 1) // page_size)
     st.session_state.history_page = max(1, min(st.session_state.history_page, total_pages))
+    # 키셋 페이지네이션: 페이지 번호 -> 시작 커서(ts_ms, id). 이력 수가 바뀌면 경계가 밀리므로 다시 계산
+    cursors = st.session_state.get("history_cursors")
+    if cursors is None or st.session_state.get("history_total") != total:
+        cursors = st.session_state.history_cursors = {1: None}
+        st.session_state.history_total = total
+    p = max(k for k in cursors if k <= st.session_state.history_page)
+    items, nxt = STORE.get_analysis_seek(cursors[p], page_size)
+    while p < st.session_state.history_page and nxt is not None:
+        p += 1
+        cursors[p] = nxt
+        items, nxt = STORE.get_analysis_seek(nxt, page_size)
+    if nxt is not None:
+        cursors[p + 1] = nxt
 
     buttons_count = min(total_pages, 10)
     cols = st.columns([1] * buttons_count + [10])
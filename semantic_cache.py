@@ -0,0 +1,105 @@
+"""In-memory semantic cache keyed by embedding cosine similarity.
+
+Entries live in rows of a preallocated (optionally float16) matrix so a
+lookup is a single matrix-vector product instead of a Python loop. Each
+entry belongs to a namespace (e.g. the receiving MSISDN) so cached results
+never cross tenants, expires after a TTL, and is evicted first-in-first-out
+once capacity is hit.
+"""
+
+import threading
+import time
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+
+from semantic_cache_jit import topk_cos
+
+
+class SemanticCache:
+    """Fixed-capacity vector cache returning the value of the nearest entry.
+
+    Methods:
+      - get(namespace, vec) -> value or None when no entry clears the threshold
+      - put(namespace, vec, value)
+    """
+
+    def __init__(self, capacity: int = 1024, threshold: float = 0.93, ttl_s: float = 900.0,
+                 dtype: Any = np.float32) -> None:
+        self._capacity = max(1, int(capacity))
+        self._dtype = np.dtype(dtype)
+        self._threshold = float(threshold)
+        self._ttl_s = float(ttl_s)
+        self._mat: Optional[np.ndarray] = None  # allocated on first put (dims from the model)
+        self._ns_ids = np.full(self._capacity, -1, dtype=np.int32)
+        self._ts = np.zeros(self._capacity, dtype=np.float64)
+        self._values: List[Any] = [None] * self._capacity
+        # Namespace ids are released once their last row is overwritten, so the map
+        # never holds more namespaces than the cache has rows
+        self._ns_map: Dict[Hashable, int] = {}
+        self._ns_keys: Dict[int, Hashable] = {}
+        self._ns_rows: Dict[int, int] = {}
+        self._free_nids: List[int] = []
+        self._next = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vec: Any) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n > 0 else v
+
+    def get(self, namespace: Hashable, vec: Any) -> Optional[Any]:
+        q = self._normalize(vec)
+        with self._lock:
+            nid = self._ns_map.get(namespace)
+            if nid is None or self._mat is None or self._size == 0 or q.shape[0] != self._mat.shape[1]:
+                return None
+            n = self._size
+            live = (self._ns_ids[:n] == nid) & (self._ts[:n] >= time.monotonic() - self._ttl_s)
+            if not live.any():
+                return None
+            idx, sims = topk_cos(self._mat[:n], q, live, k=1)
+            if sims[0] < self._threshold:
+                return None
+            return self._values[int(idx[0])]
+
+    def put(self, namespace: Hashable, vec: Any, value: Any) -> None:
+        v = self._normalize(vec)
+        with self._lock:
+            if self._mat is None or self._mat.shape[1] != v.shape[0]:
+                self._mat = np.zeros((self._capacity, v.shape[0]), dtype=self._dtype)
+                self._ns_ids.fill(-1)
+                self._ns_map.clear()
+                self._ns_keys.clear()
+                self._ns_rows.clear()
+                self._free_nids.clear()
+                self._next = 0
+                self._size = 0
+            i = self._next
+            old = int(self._ns_ids[i])
+            if old >= 0:
+                self._release_row(old)
+            nid = self._ns_map.get(namespace)
+            if nid is None:
+                nid = self._free_nids.pop() if self._free_nids else len(self._ns_map)
+                self._ns_map[namespace] = nid
+                self._ns_keys[nid] = namespace
+            self._ns_rows[nid] = self._ns_rows.get(nid, 0) + 1
+            self._mat[i] = v
+            self._ns_ids[i] = nid
+            self._ts[i] = time.monotonic()
+            self._values[i] = value
+            self._next = (i + 1) % self._capacity
+            self._size = min(self._size + 1, self._capacity)
+
+    def _release_row(self, nid: int) -> None:
+        # Caller holds the lock; drops the namespace once it has no rows left
+        left = self._ns_rows[nid] - 1
+        if left:
+            self._ns_rows[nid] = left
+            return
+        del self._ns_rows[nid]
+        del self._ns_map[self._ns_keys.pop(nid)]
+        self._free_nids.append(nid)
@@ -0,0 +1,172 @@
+"""Top-k cosine selection for the semantic cache, JIT-compiled when possible.
+
+``topk_cos`` scores every live row of the cache matrix against a normalised
+query and returns the best ``k`` rows. When numba is installed the scoring
+loop and the selection run as one compiled kernel (rows scored in parallel);
+otherwise it falls back to NumPy. Numba does not support float16 on CPU, so
+half-precision matrices are passed as their raw uint16 bits and decoded
+through a 64K-entry lookup table inside the kernel.
+
+Kernels are compiled lazily on first use so importing this module stays
+cheap; compiling takes seconds, so services call ``warmup()`` at startup
+(from a worker thread, never the event loop). Callers run on worker threads
+(Streamlit script runner, thread pools), so the TBB threading layer is
+avoided: a parallel kernel launched off the main thread under TBB leaves the
+process hanging at exit. Only the workqueue layer is not thread-safe, so
+launches are serialised until the first one reveals which layer numba
+picked, and from then on only when that layer is workqueue.
+"""
+
+import os
+
+import threading
+from typing import Any, Optional, Tuple
+
+import numpy as np
+
+# Score assigned to masked rows; below any cosine similarity
+MASKED_SCORE = -2.0
+
+_kernels: Optional[Tuple[Any, Any]] = None
+_kernels_lock = threading.Lock()
+_launch_lock = threading.Lock()
+_serialise_launches = True  # until the first launch tells us the threading layer
+_HAS_NUMBA: Optional[bool] = None
+_F16_LUT: Optional[np.ndarray] = None
+
+
+def _build_kernels() -> Optional[Tuple[Any, Any]]:
+    try:
+        import numba
+    except Exception:
+        return None
+    if not os.getenv("NUMBA_THREADING_LAYER"):
+        numba.config.THREADING_LAYER_PRIORITY = ["omp", "workqueue", "tbb"]
+
+    @numba.njit(inline="always")
+    def _insert(top_idx, top_val, i, s):
+        # Keep top_val sorted descending; top_val[-1] is the current k-th best
+        k = top_val.shape[0]
+        if s <= top_val[k - 1]:
+            return
+        j = k - 1
+        while j > 0 and top_val[j - 1] < s:
+            top_val[j] = top_val[j - 1]
+            top_idx[j] = top_idx[j - 1]
+            j -= 1
+        top_val[j] = s
+        top_idx[j] = i
+
+    @numba.njit(parallel=True, fastmath=True, cache=False)
+    def _topk_f32(mat, q, valid, k):
+        n, d = mat.shape
+        scores = np.empty(n, dtype=np.float32)
+        for i in numba.prange(n):
+            if not valid[i]:
+                scores[i] = MASKED_SCORE
+                continue
+            acc = np.float32(0.0)
+            for j in range(d):
+                acc += mat[i, j] * q[j]
+            scores[i] = acc
+        top_idx = np.full(k, -1, dtype=np.int64)
+        top_val = np.full(k, MASKED_SCORE - 1.0, dtype=np.float32)
+        for i in range(n):
+            _insert(top_idx, top_val, i, scores[i])
+        return top_idx, top_val
+
+    @numba.njit(parallel=True, fastmath=True, cache=False)
+    def _topk_f16bits(bits, q, valid, k, lut):
+        n, d = bits.shape
+        scores = np.empty(n, dtype=np.float32)
+        for i in numba.prange(n):
+            if not valid[i]:
+                scores[i] = MASKED_SCORE
+                continue
+            acc = np.float32(0.0)
+            for j in range(d):
+                acc += lut[bits[i, j]] * q[j]
+            scores[i] = acc
+        top_idx = np.full(k, -1, dtype=np.int64)
+        top_val = np.full(k, MASKED_SCORE - 1.0, dtype=np.float32)
+        for i in range(n):
+            _insert(top_idx, top_val, i, scores[i])
+        return top_idx, top_val
+
+    return _topk_f32, _topk_f16bits
+
+
+def _get_kernels() -> Optional[Tuple[Any, Any]]:
+    global _kernels, _HAS_NUMBA, _F16_LUT
+    if _HAS_NUMBA is None:
+        with _kernels_lock:
+            if _HAS_NUMBA is None:
+                _kernels = _build_kernels()
+                if _kernels is not None:
+                    _F16_LUT = np.arange(1 << 16, dtype=np.uint32).astype(np.uint16).view(np.float16).astype(np.float32)
+                _HAS_NUMBA = _kernels is not None
+    return _kernels
+
+
+def _threading_layer() -> str:
+    try:
+        import numba
+        return numba.threading_layer()
+    except Exception:
+        return "workqueue"  # unknown: keep serialising
+
+
+def _launch(kernel: Any, *args: Any) -> Tuple[np.ndarray, np.ndarray]:
+    global _serialise_launches
+    if not _serialise_launches:
+        return kernel(*args)
+    with _launch_lock:
+        out = kernel(*args)
+        _serialise_launches = _threading_layer() == "workqueue"
+        return out
+
+
+def _topk_numpy(mat: np.ndarray, q: np.ndarray, valid: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    scores = np.where(valid, mat @ q, MASKED_SCORE).astype(np.float32, copy=False)
+    k = min(k, scores.shape[0])
+    idx = np.argpartition(-scores, k - 1)[:k]
+    idx = idx[np.argsort(-scores[idx])]
+    return idx, scores[idx]
+
+
+def topk_cos(mat: np.ndarray, q: np.ndarray, valid: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """Return ``(indices, scores)`` of the ``k`` best rows, best first.
+
+    ``mat`` rows and ``q`` must already be L2-normalised; rows where ``valid``
+    is False score ``MASKED_SCORE``.
+    """
+    n = mat.shape[0]
+    k = max(1, min(int(k), n))
+    q32 = np.ascontiguousarray(q, dtype=np.float32)
+    valid = np.ascontiguousarray(valid, dtype=np.bool_)
+    kernels = _get_kernels()
+    if kernels is not None:
+        topk_f32, topk_f16bits = kernels
+        try:
+            if mat.dtype == np.float16:
+                return _launch(topk_f16bits, np.ascontiguousarray(mat).view(np.uint16), q32, valid, k, _F16_LUT)
+            if mat.dtype == np.float32:
+                return _launch(topk_f32, np.ascontiguousarray(mat), q32, valid, k)
+        except Exception:
+            pass  # compile/launch failure: score with NumPy instead
+    return _topk_numpy(mat, q32, valid, k)
+
+
+def warmup() -> bool:
+    """Compile both kernels now instead of on the first lookup.
+
+    Blocks for the compile; call it off the event loop. Returns True when the
+    numba kernels are in use, False when lookups fall back to NumPy.
+    """
+    if _get_kernels() is None:
+        return False
+    q = np.zeros(4, dtype=np.float32)
+    valid = np.ones(1, dtype=np.bool_)
+    for dtype in (np.float32, np.float16):
+        topk_cos(np.zeros((1, 4), dtype=dtype), q, valid)
+    return True
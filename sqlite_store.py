@@ -1,13 +1,152 @@
-"""SQLite-backed persistence for SMS inbox and analysis records.
+"""SQLite-backed persistence for SMS inbox, analysis records and embeddings.
 
-Behavior is kept identical to the original implementation; this refactor adds
-type hints, docstrings, and small structural cleanups without changing logic.
+One read/write connection sits behind a background flusher that group-commits
+queued writes; a small pool of read-only connections serves reads under WAL.
+
+Schema (versioned through ``PRAGMA user_version``, migrated in place on open):
+  - analysis: ``WITHOUT ROWID`` keyed by the TEXT id, JSON columns stored as
+    BLOB (orjson, zstd-compressed when large and ``zstandard`` is installed),
+    ordered and paged by the integer ``ts_ms`` column; ``ts`` keeps the
+    caller's string for display.
+  - sms: inbox rows keyed by ``id_num``, with a covering index for the
+    recent-SMS poll.
+  - embeddings: float32 vector cache keyed by text hash.
+  - meta: row counters kept by triggers, so counting is a single lookup.
+
+Tables are ``STRICT`` when the SQLite library supports it (3.37+).
 """
 
 import os
 import json
+import queue
 import sqlite3
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+import atexit
+import time
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+from uuid import uuid4
+
+import orjson
+
+try:
+    import zstandard  # optional: compress large JSON columns
+except Exception:
+    zstandard = None
+
+
+# Statements are module constants so each call reuses the same string object and
+# hits the connection's compiled-statement cache.
+# ts keeps the caller's string for display; ts_ms (epoch milliseconds) is what rows
+# are ordered and paged by, so the index holds fixed-width integers.
+_ANALYSIS_COLS = "id, sms, normalized, hits, context, answer, ts, ts_ms"
+
+_SQL_INSERT_ANALYSIS = """
+INSERT INTO analysis (id, sms, normalized, hits, context, answer, ts, ts_ms)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+  sms=excluded.sms,
+  normalized=excluded.normalized,
+  hits=excluded.hits,
+  context=excluded.context,
+  answer=excluded.answer,
+  ts=excluded.ts,
+  ts_ms=excluded.ts_ms
+"""
+_SQL_COUNT_ANALYSIS = "SELECT v FROM meta WHERE k = 'analysis_count'"
+# OFFSET paging walks idx_analysis_ts_ms alone (it covers ts_ms and id) to pick the
+# page's ids, so only the rows actually returned are read from the table.
+_SQL_ANALYSIS_PAGE = (
+    f"SELECT {_ANALYSIS_COLS} FROM analysis WHERE id IN"
+    " (SELECT id FROM analysis ORDER BY ts_ms DESC, id DESC LIMIT ? OFFSET ?)"
+    " ORDER BY ts_ms DESC, id DESC"
+)
+_SQL_ANALYSIS_FIRST = f"SELECT {_ANALYSIS_COLS} FROM analysis ORDER BY ts_ms DESC, id DESC LIMIT ?"
+_SQL_ANALYSIS_AFTER = (
+    f"SELECT {_ANALYSIS_COLS} FROM analysis"
+    " WHERE ts_ms <= ? AND (ts_ms < ? OR id < ?) ORDER BY ts_ms DESC, id DESC LIMIT ?"
+)
+
+_SQL_INSERT_SMS = """
+INSERT INTO sms (id_num, message, sender, receiver, provider_message_id, received_at, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id_num) DO UPDATE SET
+  message=excluded.message,
+  sender=excluded.sender,
+  receiver=excluded.receiver,
+  provider_message_id=excluded.provider_message_id,
+  received_at=excluded.received_at,
+  created_at=excluded.created_at
+"""
+_SQL_SMS_RECENT = (
+    "SELECT id_num, message, sender, receiver, provider_message_id, received_at"
+    " FROM sms WHERE id_num > ? ORDER BY id_num ASC LIMIT ?"
+)
+_SQL_SMS_MAX_ID = "SELECT id_num FROM sms ORDER BY id_num DESC LIMIT 1"
+
+_SQL_GET_EMBEDDING = "SELECT vec FROM embeddings WHERE hash = ?"
+_SQL_PUT_EMBEDDING = "INSERT OR IGNORE INTO embeddings (hash, model, dims, vec) VALUES (?, ?, ?, ?)"
+
+# STRICT tables (type-checked columns) need SQLite 3.37+. analysis is keyed by a TEXT
+# uuid, so it is stored WITHOUT ROWID: rows live in the primary-key b-tree and an id
+# lookup is one seek instead of id index -> rowid -> table.
+_STRICT = sqlite3.sqlite_version_info >= (3, 37, 0)
+_ANALYSIS_DDL = """
+CREATE TABLE IF NOT EXISTS {name} (
+  id TEXT PRIMARY KEY,
+  sms TEXT,
+  normalized BLOB,
+  hits BLOB,
+  context BLOB,
+  answer TEXT,
+  ts TEXT NOT NULL,
+  ts_ms INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID""" + (", STRICT;" if _STRICT else ";")
+_SMS_DDL = """
+CREATE TABLE IF NOT EXISTS {name} (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  id_num INTEGER UNIQUE,
+  message TEXT,
+  sender TEXT,
+  receiver TEXT,
+  provider_message_id TEXT,
+  received_at TEXT,
+  created_at TEXT
+)""" + (" STRICT;" if _STRICT else ";")
+
+# How long a read waits for a pooled connection before falling back to the writer
+_READER_WAIT_S = float(os.getenv("SQLITE_READ_WAIT_MS") or 2000) / 1000.0
+
+# Rows per query issued by the iter_* generators (one short read per batch)
+_FETCH_BATCH = 64
+
+# Stored in PRAGMA user_version once _ensure_schema has run; bump it whenever the
+# schema or its migrations change so existing files pick them up.
+_SCHEMA_VERSION = 2
+
+# Per-connection compiled-statement cache (sqlite3 default is 128)
+_CACHED_STATEMENTS = 256
+
+# Group commit: the flusher takes everything already queued (up to the max) into
+# one transaction, lingering up to the window for more. The default window is 0:
+# bursts batch up on their own while the previous commit runs, and a lone
+# synchronous write is not delayed.
+_WRITE_BATCH_MAX = 200
+_WRITE_BATCH_WINDOW_S = float(os.getenv("SQLITE_WRITE_WINDOW_MS") or 0) / 1000.0
+
+
+class _Write:
+    __slots__ = ("sql", "params", "many", "done", "error")
+
+    def __init__(self, sql: Optional[str], params: Any, many: bool) -> None:
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
 
 
 def _env(name: str, default: Optional[str] = None) -> Optional[str]:
@@ -15,19 +154,54 @@ def _env(name: str, default: Optional[str] = None) -> Optional[str]:
     return v if v is not None and v != "" else default
 
 
+def _tune_connection(conn: sqlite3.Connection) -> None:
+    """Per-connection PRAGMAs: larger page cache, in-memory temp tables, mmap reads."""
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute(f"PRAGMA cache_size=-{int(_env('SQLITE_CACHE_KB', '65536') or 65536)};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute(f"PRAGMA mmap_size={int(_env('SQLITE_MMAP_SIZE', '268435456') or 0)};")
+
+
+def _ts_to_ms(ts: Any) -> int:
+    """Epoch milliseconds for an ISO-8601 / 'YYYY-MM-DD HH:MM:SS' string; naive = local time, 0 if unparseable."""
+    try:
+        return int(datetime.fromisoformat(str(ts).replace("Z", "+00:00")).timestamp() * 1000)
+    except Exception:
+        return 0
+
+
 class SQLiteStore:
-    """Lightweight SQLite store with a stable interface.
+    """SQLite store used by both the FastAPI app and the Streamlit UI.
 
-    Methods provided (unchanged):
+    Methods:
       - save_analysis(rec)
       - get_analysis_page(page, page_size) -> (items, total)
+      - get_analysis_seek(cursor, page_size) -> (items, next_cursor)
+      - count_analysis()
       - add_sms(id_num, row)
+      - add_sms_many(rows)
       - get_sms_recent(since_id, limit)
+      - iter_sms_recent(since_id, limit) / iter_analysis_page(page, page_size)
+        (generators; each batch of rows is its own short read, so a slow consumer
+        does not hold a reader connection)
       - get_sms_max_id()
+      - get_embedding(key) / put_embedding(key, vec, model, dims)
+      - flush()
+
+    Writes go through one read/write connection guarded by a lock; reads use a
+    small pool of read-only connections so they run alongside the writer under
+    WAL instead of queueing behind it. Writes are queued to a background
+    flusher that group-commits them; SMS and analysis writes wait for their
+    commit by default, embedding cache writes do not. ``flush()`` drains the
+    queue.
 
     Configure with env:
       STORAGE_BACKEND=sqlite
       SQLITE_PATH=/home/data/app.db  (Azure App Service Linux: use /home)
+      SQLITE_READERS=4  (read-only connections; 0 = read through the writer)
+      SQLITE_READ_WAIT_MS=2000  (wait for a free reader before reading through the writer)
+      SQLITE_CACHE_KB=65536, SQLITE_MMAP_SIZE=268435456  (per connection; mmap 0 = off)
+      SQLITE_WRITE_WINDOW_MS=0  (extra time the writer waits to grow a group commit)
     """
 
     def __init__(self, db_path: Optional[str] = None) -> None:
@@ -38,130 +212,304 @@ class SQLiteStore:
             os.makedirs(os.path.dirname(path), exist_ok=True)
         except Exception:
             pass
-        self._conn = sqlite3.connect(path, check_same_thread=False)
-        self._conn.execute("PRAGMA journal_mode=WAL;")
-        self._conn.execute("PRAGMA synchronous=NORMAL;")
-        self._conn.execute("PRAGMA busy_timeout=5000;")
-        self._ensure_schema()
+        self._rw = sqlite3.connect(path, check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
+        # page_size only takes effect on a new file, before WAL is enabled (no-op afterwards)
+        self._rw.execute("PRAGMA page_size=8192;")
+        self._rw.execute("PRAGMA journal_mode=WAL;")
+        self._rw.execute("PRAGMA synchronous=NORMAL;")
+        self._rw.execute("PRAGMA wal_autocheckpoint=1000;")
+        _tune_connection(self._rw)
+        self._write_lock = threading.Lock()
+        # The DDL/migrations only run when the file predates the current schema version
+        if self._rw.execute("PRAGMA user_version;").fetchone()[0] < _SCHEMA_VERSION:
+            self._ensure_schema()
+        # Readers open after the schema exists (and the WAL files are created)
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        try:
+            # Not immutable=1: that skips locking and the WAL, so it would miss rows not yet
+            # checkpointed and read torn pages while a checkpoint rewrites the file.
+            uri = f"file:{quote(os.path.abspath(path))}?mode=ro"
+            for _ in range(max(0, int(_env("SQLITE_READERS", "4") or 4))):
+                conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
+                conn.execute("PRAGMA query_only=1;")
+                conn.execute("PRAGMA read_uncommitted=0;")
+                _tune_connection(conn)
+                self._readers.put(conn)
+        except Exception:
+            pass  # e.g. ':memory:' or a read-only mount: fall back to the writer connection
+        self._n_readers = self._readers.qsize()
+        self._wq: "queue.Queue[_Write]" = queue.Queue()
+        threading.Thread(target=self._flusher, name="sqlite-writer", daemon=True).start()
+        atexit.register(self.flush)
         self._enabled = True
 
     @property
     def enabled(self) -> bool:
         return bool(self._enabled)
 
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        if self._n_readers == 0:
+            with self._write_lock:
+                yield self._rw
+            return
+        try:
+            conn = self._readers.get(timeout=_READER_WAIT_S)
+        except queue.Empty:
+            # Every pooled reader is checked out: read through the writer rather than stall
+            with self._write_lock:
+                yield self._rw
+            return
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def _submit(self, sql: str, params: Any, many: bool = False, wait: bool = True) -> None:
+        w = _Write(sql, params, many)
+        self._wq.put(w)
+        if wait:
+            w.done.wait()
+            if w.error is not None:
+                raise w.error
+
+    def flush(self) -> None:
+        """Block until every write queued before this call has been committed."""
+        if getattr(self, "_wq", None) is None:
+            return
+        w = _Write(None, None, False)
+        self._wq.put(w)
+        w.done.wait()
+
+    def _flusher(self) -> None:
+        while True:
+            batch = [self._wq.get()]
+            deadline = time.monotonic() + _WRITE_BATCH_WINDOW_S
+            while len(batch) < _WRITE_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._wq.get(timeout=remaining) if remaining > 0 else self._wq.get_nowait())
+                except queue.Empty:
+                    break
+            writes = [w for w in batch if w.sql is not None]
+            with self._write_lock:
+                try:
+                    with self._rw:
+                        for w in writes:
+                            self._apply(w)
+                except Exception:
+                    # One bad write must not take the batch down: retry each on its own
+                    for w in writes:
+                        try:
+                            with self._rw:
+                                self._apply(w)
+                        except Exception as e:
+                            w.error = e
+            for w in batch:
+                w.done.set()
+
+    def _apply(self, w: _Write) -> None:
+        if w.many:
+            self._rw.executemany(w.sql, w.params)
+        else:
+            self._rw.execute(w.sql, w.params)
+
     def _ensure_schema(self) -> None:
-        cur = self._conn.cursor()
+        # Another process may be migrating the same file: take the write lock first and
+        # re-check the version under it, so only one of them runs the DDL/migrations
+        self._rw.execute("BEGIN IMMEDIATE;")
+        try:
+            if self._rw.execute("PRAGMA user_version;").fetchone()[0] >= _SCHEMA_VERSION:
+                self._rw.rollback()
+                return
+            self._migrate_schema()
+            self._rw.execute(f"PRAGMA user_version={_SCHEMA_VERSION};")
+            self._rw.commit()
+        except BaseException:
+            self._rw.rollback()
+            raise
+
+    def _migrate_schema(self) -> None:
+        # Runs inside _ensure_schema's transaction
         # analysis table
-        cur.execute(
+        self._rw.execute(_ANALYSIS_DDL.format(name="analysis"))
+        # Databases created before ts_ms: add the column and derive it from ts once
+        cols = {r[1] for r in self._rw.execute("PRAGMA table_info(analysis);")}
+        if "ts_ms" not in cols:
+            self._rw.execute("ALTER TABLE analysis ADD COLUMN ts_ms INTEGER NOT NULL DEFAULT 0;")
+            rows = self._rw.execute("SELECT id, ts FROM analysis;").fetchall()
+            self._rw.executemany(
+                "UPDATE analysis SET ts_ms = ? WHERE id = ?;", [(_ts_to_ms(ts), aid) for aid, ts in rows]
+            )
+        # Older rowid tables hold JSON as TEXT; STRICT BLOB columns only take bytes
+        self._rebuild_strict(
+            "analysis",
+            _ANALYSIS_DDL,
+            "COALESCE(id, lower(hex(randomblob(16)))), sms, CAST(normalized AS BLOB),"
+            " CAST(hits AS BLOB), CAST(context AS BLOB), answer, ts, ts_ms",
+        )
+        # (ts_ms, id) covers both the ordering and the keyset tie-break
+        self._rw.execute("DROP INDEX IF EXISTS idx_analysis_ts;")
+        self._rw.execute("DROP INDEX IF EXISTS idx_analysis_ts_id;")
+        self._rw.execute("CREATE INDEX IF NOT EXISTS idx_analysis_ts_ms ON analysis(ts_ms DESC, id DESC);")
+        # sms table
+        self._rw.execute(_SMS_DDL.format(name="sms"))
+        self._rebuild_strict(
+            "sms", _SMS_DDL, "id, id_num, message, sender, receiver, provider_message_id, received_at, created_at"
+        )
+        # get_sms_recent reads only these columns, so it is answered from this index alone
+        # (a range scan, no table lookups). idx_sms_idnum duplicated the UNIQUE(id_num) index.
+        self._rw.execute("DROP INDEX IF EXISTS idx_sms_idnum;")
+        self._rw.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sms_cover"
+            " ON sms(id_num, message, sender, receiver, provider_message_id, received_at);"
+        )
+        # Nothing filters or sorts sms by received_at; the old index only cost writes
+        self._rw.execute("DROP INDEX IF EXISTS idx_sms_recv;")
+        # embedding cache table (vec = float32 bytes)
+        self._rw.execute(
             """
-            CREATE TABLE IF NOT EXISTS analysis (
-              id TEXT PRIMARY KEY,
-              sms TEXT,
-              normalized TEXT,
-              hits TEXT,
-              context TEXT,
-              answer TEXT,
-              ts TEXT NOT NULL
+            CREATE TABLE IF NOT EXISTS embeddings (
+              hash TEXT PRIMARY KEY,
+              model TEXT,
+              dims INTEGER,
+              vec BLOB
             );
             """
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_analysis_ts ON analysis(ts);")
-        # sms table
-        cur.execute(
+        # row counters; seeded from the table the first time, then kept by triggers.
+        # An upsert that hits ON CONFLICT runs UPDATE, so it does not fire the insert trigger.
+        self._rw.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER NOT NULL);")
+        self._rw.execute(
+            "INSERT OR IGNORE INTO meta (k, v) VALUES ('analysis_count', (SELECT COUNT(1) FROM analysis));"
+        )
+        self._rw.execute(
             """
-            CREATE TABLE IF NOT EXISTS sms (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              id_num INTEGER UNIQUE,
-              message TEXT,
-              sender TEXT,
-              receiver TEXT,
-              provider_message_id TEXT,
-              received_at TEXT,
-              created_at TEXT
-            );
+            CREATE TRIGGER IF NOT EXISTS trg_analysis_count_ins AFTER INSERT ON analysis
+            BEGIN UPDATE meta SET v = v + 1 WHERE k = 'analysis_count'; END;
+            """
+        )
+        self._rw.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_analysis_count_del AFTER DELETE ON analysis
+            BEGIN UPDATE meta SET v = v - 1 WHERE k = 'analysis_count'; END;
             """
         )
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_sms_idnum ON sms(id_num);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_sms_recv ON sms(received_at);")
-        self._conn.commit()
-        cur.close()
 
-    def save_analysis(self, rec: Dict[str, Any]) -> Optional[str]:
+    def _rebuild_strict(self, name: str, ddl: str, select_cols: str) -> None:
+        """Copy a table created before the STRICT layout into one that has it (under a savepoint)."""
+        if not _STRICT:
+            return
+        row = self._rw.execute(
+            "SELECT strict FROM pragma_table_list WHERE schema = 'main' AND name = ?;", (name,)
+        ).fetchone()
+        if not row or row[0]:
+            return
+        tmp = f"{name}_new"
+        self._rw.execute("SAVEPOINT rebuild_strict;")
+        try:
+            self._rw.execute(f"DROP TABLE IF EXISTS {tmp};")
+            self._rw.execute(ddl.format(name=tmp))
+            self._rw.execute(f"INSERT INTO {tmp} SELECT {select_cols} FROM {name};")
+            # Dropping the old table takes its indexes and triggers with it (no delete
+            # triggers fire); _ensure_schema recreates them on the new table.
+            self._rw.execute(f"DROP TABLE {name};")
+            self._rw.execute(f"ALTER TABLE {tmp} RENAME TO {name};")
+        except sqlite3.Error:
+            # e.g. a value STRICT rejects: keep the old (still working) table
+            self._rw.execute("ROLLBACK TO rebuild_strict;")
+        self._rw.execute("RELEASE rebuild_strict;")
+
+    def save_analysis(self, rec: Dict[str, Any], wait: bool = True) -> Optional[str]:
         if not self.enabled:
             return None
-        from uuid import uuid4
         aid = rec.get("id") or str(uuid4())
         sms = rec.get("sms")
-        normalized = json.dumps(rec.get("normalized"), ensure_ascii=False)
-        hits = json.dumps(rec.get("hits"), ensure_ascii=False)
-        context = json.dumps(rec.get("context"), ensure_ascii=False)
+        # Absent fields are stored as NULL (zero bytes, nothing to parse on read)
+        normalized = _json_dumps_bytes(v) if (v := rec.get("normalized")) is not None else None
+        hits = _json_dumps_bytes(v) if (v := rec.get("hits")) is not None else None
+        context = _json_dumps_bytes(v) if (v := rec.get("context")) is not None else None
         answer = rec.get("answer")
         ts = rec.get("ts")
-        cur = self._conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO analysis (id, sms, normalized, hits, context, answer, ts)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-              sms=excluded.sms,
-              normalized=excluded.normalized,
-              hits=excluded.hits,
-              context=excluded.context,
-              answer=excluded.answer,
-              ts=excluded.ts
-            """,
-            (aid, sms, normalized, hits, context, answer, ts),
+        self._submit(
+            _SQL_INSERT_ANALYSIS, (aid, sms, normalized, hits, context, answer, ts, _ts_to_ms(ts)), wait=wait
         )
-        self._conn.commit()
-        cur.close()
         return str(aid)
 
+    def count_analysis(self) -> int:
+        if not self.enabled:
+            return 0
+        # Counter row maintained by triggers: one primary-key lookup instead of COUNT(*)
+        with self._read() as conn:
+            row = conn.execute(_SQL_COUNT_ANALYSIS).fetchone()
+        return int(row[0]) if row else 0
+
     def get_analysis_page(self, page: int, page_size: int) -> Tuple[List[Dict[str, Any]], int]:
         if not self.enabled:
             return [], 0
         page = max(1, int(page))
         page_size = max(1, int(page_size))
         offset = (page - 1) * page_size
-        cur = self._conn.cursor()
-        cur.execute("SELECT COUNT(1) FROM analysis")
-        total = int(cur.fetchone()[0])
-        cur.execute(
-            "SELECT id, sms, normalized, hits, context, answer, ts FROM analysis ORDER BY ts DESC LIMIT ? OFFSET ?",
-            (page_size, offset),
-        )
-        rows = cur.fetchall()
-        cur.close()
-        items: List[Dict[str, Any]] = []
-        for r in rows:
-            items.append(
-                {
-                    "id": r[0],
-                    "sms": r[1],
-                    "normalized": _json_loads_safe(r[2]),
-                    "hits": _json_loads_safe(r[3]),
-                    "context": _json_loads_safe(r[4]),
-                    "answer": r[5],
-                    "ts": r[6],
-                }
-            )
-        return items, total
+        total = self.count_analysis()
+        with self._read() as conn:
+            rows = conn.execute(_SQL_ANALYSIS_PAGE, (page_size, offset)).fetchall()
+        return [_analysis_item(r) for r in rows], total
+
+    def iter_analysis_page(self, page: int, page_size: int) -> Iterator[Dict[str, Any]]:
+        """Generator form of ``get_analysis_page`` (records only, no total); JSON is decoded per batch.
+
+        Each batch is its own short query (later batches seek past the last row), so no
+        connection is held while the consumer works through a batch.
+        """
+        if not self.enabled:
+            return
+        page = max(1, int(page))
+        left = max(1, int(page_size))
+        n = min(left, _FETCH_BATCH)
+        with self._read() as conn:
+            rows = conn.execute(_SQL_ANALYSIS_PAGE, (n, (page - 1) * left)).fetchall()
+        while rows:
+            left -= len(rows)
+            last_ms, last_id = rows[-1][7], rows[-1][0]
+            yield from map(_analysis_item, rows)
+            if left <= 0 or len(rows) < n:
+                return
+            n = min(left, _FETCH_BATCH)
+            with self._read() as conn:
+                rows = conn.execute(_SQL_ANALYSIS_AFTER, (last_ms, last_ms, last_id, n)).fetchall()
+
+    def get_analysis_seek(
+        self, cursor: Optional[Tuple[int, str]], page_size: int
+    ) -> Tuple[List[Dict[str, Any]], Optional[Tuple[int, str]]]:
+        """Keyset pagination: return the page after ``cursor`` (``None`` = newest) and the next cursor.
+
+        The cursor is the ``(ts_ms, id)`` of the last row seen, so each page is an
+        index seek instead of walking and discarding ``OFFSET`` rows. The next
+        cursor is ``None`` once the last page has been returned.
+        """
+        if not self.enabled:
+            return [], None
+        page_size = max(1, int(page_size))
+        with self._read() as conn:
+            if cursor is None:
+                rows = conn.execute(_SQL_ANALYSIS_FIRST, (page_size,)).fetchall()
+            else:
+                last_ms, last_id = cursor
+                rows = conn.execute(_SQL_ANALYSIS_AFTER, (last_ms, last_ms, last_id, page_size)).fetchall()
+        next_cursor = (rows[-1][7], rows[-1][0]) if len(rows) == page_size else None
+        return [_analysis_item(r) for r in rows], next_cursor
 
     def add_sms(self, id_num: int, row: Dict[str, Any]) -> Optional[str]:
         if not self.enabled:
             return None
-        cur = self._conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO sms (id_num, message, sender, receiver, provider_message_id, received_at, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(id_num) DO UPDATE SET
-              message=excluded.message,
-              sender=excluded.sender,
-              receiver=excluded.receiver,
-              provider_message_id=excluded.provider_message_id,
-              received_at=excluded.received_at,
-              created_at=excluded.created_at
-            """,
+        self.add_sms_many([(id_num, row)])
+        return str(id_num)
+
+    def add_sms_many(self, rows: Sequence[Tuple[int, Dict[str, Any]]], wait: bool = True) -> int:
+        """Upsert several SMS rows in one transaction; returns the number written."""
+        if not self.enabled or not rows:
+            return 0
+        params = [
             (
                 int(id_num),
                 row.get("message"),
@@ -170,55 +518,122 @@ class SQLiteStore:
                 row.get("provider_message_id"),
                 row.get("received_at"),
                 row.get("created_at"),
-            ),
-        )
-        self._conn.commit()
-        cur.close()
-        return str(id_num)
+            )
+            for id_num, row in rows
+        ]
+        # Committed (or rolled back) as a unit, together with whatever else the flusher batches
+        self._submit(_SQL_INSERT_SMS, params, many=True, wait=wait)
+        return len(params)
 
     def get_sms_recent(self, since_id: int, limit: int = 50) -> List[Dict[str, Any]]:
         if not self.enabled:
             return []
-        cur = self._conn.cursor()
-        cur.execute(
-            "SELECT id_num, message, sender, receiver, provider_message_id, received_at FROM sms WHERE id_num > ? ORDER BY id_num ASC LIMIT ?",
-            (int(since_id), int(limit)),
-        )
-        rows = cur.fetchall()
-        cur.close()
-        out: List[Dict[str, Any]] = []
-        for r in rows:
-            out.append(
-                {
-                    "id": int(r[0]),
-                    "message": r[1],
-                    "sender": r[2],
-                    "receiver": r[3],
-                    "provider_message_id": r[4],
-                    "received_at": r[5],
-                }
-            )
-        return out
+        with self._read() as conn:
+            rows = conn.execute(_SQL_SMS_RECENT, (int(since_id), int(limit))).fetchall()
+        # id_num is an INTEGER column, so rows map straight onto the response keys
+        return [dict(zip(_SMS_KEYS, r)) for r in rows]
+
+    def iter_sms_recent(self, since_id: int, limit: int = 50) -> Iterator[Dict[str, Any]]:
+        """Generator form of ``get_sms_recent``: rows are fetched and yielded in small batches.
+
+        Each batch is its own short query continuing after the last id_num, so the read
+        connection goes back to the pool before anything is yielded.
+        """
+        if not self.enabled:
+            return
+        last = int(since_id)
+        left = int(limit)
+        while left > 0:
+            n = min(left, _FETCH_BATCH)
+            with self._read() as conn:
+                rows = conn.execute(_SQL_SMS_RECENT, (last, n)).fetchall()
+            for r in rows:
+                yield dict(zip(_SMS_KEYS, r))
+            if len(rows) < n:
+                return
+            left -= n
+            last = rows[-1][0]
 
     def get_sms_max_id(self) -> int:
         if not self.enabled:
             return 0
-        cur = self._conn.cursor()
-        cur.execute("SELECT COALESCE(MAX(id_num), 0) FROM sms")
-        v = cur.fetchone()[0]
-        cur.close()
+        with self._read() as conn:
+            row = conn.execute(_SQL_SMS_MAX_ID).fetchone()
         try:
-            return int(v or 0)
+            return int(row[0] or 0) if row else 0
         except Exception:
             return 0
 
+    def get_embedding(self, key: str) -> Optional[List[float]]:
+        if not self.enabled:
+            return None
+        with self._read() as conn:
+            row = conn.execute(_SQL_GET_EMBEDDING, (key,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return array("f", row[0]).tolist()
+
+    def put_embedding(self, key: str, vec: Sequence[float], model: str, dims: Optional[int] = None,
+                      wait: bool = False) -> None:
+        if not self.enabled:
+            return
+        blob = array("f", vec).tobytes()
+        self._submit(_SQL_PUT_EMBEDDING, (key, model, int(dims if dims is not None else len(vec)), blob), wait=wait)
+
+
+_SMS_KEYS = ("id", "message", "sender", "receiver", "provider_message_id", "received_at")
+
+
+def _analysis_item(r: Sequence[Any]) -> Dict[str, Any]:
+    return {
+        "id": r[0],
+        "sms": r[1],
+        "normalized": _json_loads_safe(r[2]),
+        "hits": _json_loads_safe(r[3]),
+        "context": _json_loads_safe(r[4]),
+        "answer": r[5],
+        "ts": r[6],
+    }
+
+
+# zstd frames start with this magic; JSON text never does, so old rows still parse
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_ZSTD_MIN_BYTES = 512  # below this the frame overhead eats the gain
+_zstd_local = threading.local()  # compressor/decompressor objects are not thread-safe
+
+
+def _zstd_ctx() -> Any:
+    ctx = getattr(_zstd_local, "ctx", None)
+    if ctx is None:
+        ctx = _zstd_local.ctx = (zstandard.ZstdCompressor(level=3), zstandard.ZstdDecompressor())
+    return ctx
+
+
+def _json_dumps_bytes(v: Any) -> bytes:
+    # UTF-8 JSON bytes stored as BLOB; json fallback for values orjson rejects
+    try:
+        b = orjson.dumps(v, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    except TypeError:
+        b = json.dumps(v, ensure_ascii=False, default=str).encode("utf-8")
+    if zstandard is not None and len(b) >= _ZSTD_MIN_BYTES:
+        b = _zstd_ctx()[0].compress(b)
+    return b
+
 
 def _json_loads_safe(s: Any) -> Any:
+    # Rows written before the BLOB switch hold TEXT; orjson parses both.
+    # One generic parser serves all three columns: schema-typed decoders (msgspec
+    # TypedDict/Struct) measured no faster on normalized, slower on hits, and drop
+    # keys missing from the schema, while callers (st.json, rec.get) want plain dicts.
+    if s is None:
+        return None
     try:
-        if isinstance(s, (bytes, bytearray)):
-            s = s.decode("utf-8", errors="ignore")
-        if isinstance(s, str):
-            return json.loads(s)
+        if isinstance(s, (bytes, bytearray, memoryview)) and bytes(s[:4]) == _ZSTD_MAGIC:
+            if zstandard is None:
+                return s
+            s = _zstd_ctx()[1].decompress(s)
+        if isinstance(s, (bytes, bytearray, memoryview, str)):
+            return orjson.loads(s)
         return s
     except Exception:
         return s
@@ -5,21 +5,36 @@ SQLite-backed store when available, or ``None`` to safely fall back to the
 in-memory code paths used elsewhere in the app.
 """
 
+import threading
 from typing import Optional
 
 from sqlite_store import SQLiteStore
 
+# One store per process: the app module and the Streamlit script both call the
+# factory, and each construction reopens the database, its WAL and shm files.
+_STORE: Optional[SQLiteStore] = None
+_LOCK = threading.Lock()
+
 
 def build_store_from_env() -> Optional[SQLiteStore]:
     """Build a store instance from environment.
 
     Behavior is intentionally simple: always attempt SQLite initialization and
     return ``None`` if anything fails so that the rest of the application can
-    operate in in-memory mode without raising.
+    operate in in-memory mode without raising. A successfully opened store is
+    memoised and returned to later callers; failures are retried next call.
     """
-    try:
-        store = SQLiteStore()
-        return store if store.enabled else None
-    except Exception:
-        return None
-
+    global _STORE
+    if _STORE is not None:
+        return _STORE
+    with _LOCK:
+        if _STORE is not None:
+            return _STORE
+        try:
+            store = SQLiteStore()
+        except Exception:
+            return None
+        if not store.enabled:
+            return None
+        _STORE = store
+        return store
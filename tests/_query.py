@@ -0,0 +1,50 @@
+"""Load query.py's definitions (everything above the Streamlit UI) for tests.
+
+query.py is a Streamlit script: importing it would render the page and call the
+webhook. Tests only need the helpers, so the source is executed up to the UI
+section into a fresh module with a throwaway SQLite path.
+"""
+
+import importlib.util
+import os
+import tempfile
+import types
+from unittest import mock
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_UI_MARKER = "# ====== Streamlit UI ======"
+
+HAS_STREAMLIT = importlib.util.find_spec("streamlit") is not None
+
+
+class SessionState(dict):
+    """Dict with attribute access, like ``st.session_state``."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def load_query() -> types.ModuleType:
+    path = os.path.join(_ROOT, "query.py")
+    with open(path, encoding="utf-8-sig") as f:
+        src = f.read()
+    src = src[: src.index(_UI_MARKER)]
+    mod = types.ModuleType("query_under_test")
+    mod.__file__ = path
+    tmp = tempfile.mkdtemp()
+    env = {
+        "SQLITE_PATH": os.path.join(tmp, "app.db"),
+        "AZURE_OPENAI_ENDPOINT": "https://aoai.invalid",
+        "AZURE_OPENAI_KEY": "test",
+        "SEARCH_ENDPOINT": "https://search.invalid",
+        "SEARCH_ADMIN_KEY": "test",
+    }
+    with mock.patch.dict(os.environ, env):
+        exec(compile(src, path, "exec"), mod.__dict__)
+    return mod
@@ -0,0 +1,64 @@
+"""app_sms in-memory inbox fallback: bounded eviction and since_id paging."""
+
+import asyncio
+import importlib.util
+import os
+import tempfile
+import unittest
+from collections import deque
+from unittest import mock
+
+import orjson
+
+HAS_FASTAPI = importlib.util.find_spec("fastapi") is not None
+
+
+@unittest.skipUnless(HAS_FASTAPI, "fastapi not installed")
+class InboxFallbackTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        tmp = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ, {"SQLITE_PATH": os.path.join(tmp, "app.db")}):
+            import app_sms
+        cls.app_sms = app_sms
+
+    def _fill(self, maxlen: int, n: int):
+        m = self.app_sms
+        ids = iter(range(1, n + 1))
+        patches = (
+            mock.patch.object(m, "STORE", None),
+            mock.patch.object(m, "INBOX", deque(maxlen=maxlen)),
+            mock.patch.object(m, "INBOX_IDS", deque(maxlen=maxlen)),
+            mock.patch.object(m, "_next_id", lambda: next(ids)),
+        )
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        async def go():
+            for i in range(n):
+                await m.add_to_inbox(f"m{i + 1}", None, None, None, None, trigger_auto=False)
+            await asyncio.sleep(0)
+
+        asyncio.run(go())
+
+    def _recent(self, **kw):
+        resp = asyncio.run(self.app_sms.get_recent(**kw))
+        return [r["id"] for r in orjson.loads(resp.body)]
+
+    def test_eviction_keeps_ids_aligned(self) -> None:
+        self._fill(maxlen=3, n=5)
+        self.assertEqual(list(self.app_sms.INBOX_IDS), [3, 4, 5])
+        self.assertEqual([r["id"] for r in self.app_sms.INBOX], [3, 4, 5])
+        self.assertEqual(self._recent(since_id=0), [5, 4, 3])
+        self.assertEqual(self._recent(since_id=3), [5, 4])
+        self.assertEqual(self._recent(since_id=4, limit=1), [5])
+        self.assertEqual(self._recent(since_id=5), [])
+
+    def test_single_slot_inbox(self) -> None:
+        self._fill(maxlen=1, n=3)
+        self.assertEqual(self._recent(since_id=0), [3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""app_sms SMS write queue: retries, broadcast only after a write, queue reuse."""
+
+import asyncio
+import importlib.util
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+HAS_FASTAPI = importlib.util.find_spec("fastapi") is not None
+
+
+class FlakyStore:
+    """Fails the first ``fail_times`` batch writes and any batch holding a ``bad`` id."""
+
+    def __init__(self, fail_times: int = 0, bad=()):
+        self.fail_times = fail_times
+        self.bad = set(bad)
+        self.rows = {}
+
+    def add_sms_many(self, rows, wait=True):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise RuntimeError("database is locked")
+        if any(id_num in self.bad for id_num, _ in rows):
+            raise RuntimeError("constraint failed")
+        self.rows.update(rows)
+        return len(rows)
+
+
+@unittest.skipUnless(HAS_FASTAPI, "fastapi not installed")
+class StoreWriterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        tmp = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ, {"SQLITE_PATH": os.path.join(tmp, "app.db")}):
+            import app_sms
+        cls.app_sms = app_sms
+
+    def setUp(self) -> None:
+        m = self.app_sms
+        for name, value in (("STORE_WRITE_BACKOFF_S", 0.0), ("_STORE_WRITE_Q", None), ("_store_writer", None)):
+            p = mock.patch.object(m, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _run(self, store, ids):
+        m = self.app_sms
+
+        async def go():
+            events = asyncio.Queue()
+            m._subscribers.add(events)
+            try:
+                with mock.patch.object(m, "STORE", store):
+                    for i in ids:
+                        m._enqueue_sms_write({"id": i, "message": f"m{i}"}, "2024-01-01T00:00:00")
+                    await asyncio.wait_for(m._STORE_WRITE_Q.join(), timeout=5)
+            finally:
+                m._subscribers.discard(events)
+                m._store_writer.cancel()
+            out = []
+            while not events.empty():
+                out.append(events.get_nowait()["id"])
+            return out
+
+        return asyncio.run(go())
+
+    def test_transient_failure_is_retried_before_broadcast(self) -> None:
+        store = FlakyStore(fail_times=2)
+        with self.assertLogs("app_sms", "WARNING"):
+            self.assertEqual(self._run(store, [1, 2, 3]), [1, 2, 3])
+        self.assertEqual(sorted(store.rows), [1, 2, 3])
+
+    def test_bad_row_is_isolated_and_not_broadcast(self) -> None:
+        store = FlakyStore(bad={2})
+        with self.assertLogs("app_sms", "WARNING") as logs:
+            self.assertEqual(self._run(store, [1, 2, 3]), [1, 3])
+        self.assertIn("dropping SMS 2", logs.output[-1])
+        self.assertEqual(sorted(store.rows), [1, 3])
+
+    def test_pending_rows_survive_writer_restart_on_new_loop(self) -> None:
+        m = self.app_sms
+        store = FlakyStore()
+        self._run(store, [1])
+        # Rows queued after the first loop ended must carry over to the next writer
+        m._STORE_WRITE_Q.put_nowait((7, {"message": "late"}))
+        self.assertEqual(self._run(store, [8]), [7, 8])
+        self.assertEqual(sorted(store.rows), [1, 7, 8])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+"""create_upload_azure_index: transport retries and cancellation on failure."""
+
+import asyncio
+import functools
+import importlib
+import importlib.util
+import os
+import unittest
+from unittest import mock
+
+import orjson
+
+HAS_DEPS = all(importlib.util.find_spec(m) for m in ("httpx", "tqdm", "dotenv", "requests"))
+
+_ENV = {
+    "SEARCH_ENDPOINT": "https://search.invalid",
+    "SEARCH_ADMIN_KEY": "test",
+    "AZURE_OPENAI_ENDPOINT": "https://aoai.invalid",
+    "AZURE_OPENAI_KEY": "test",
+}
+
+
+@unittest.skipUnless(HAS_DEPS, "indexer dependencies not installed")
+class IndexerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        with mock.patch.dict(os.environ, _ENV):
+            cls.idx = importlib.import_module("create_upload_azure_index")
+
+    def setUp(self) -> None:
+        # Backoff sleeps are real seconds; skip them
+        p = mock.patch.object(self.idx, "MAX_RETRIES", 3)
+        p.start()
+        self.addCleanup(p.stop)
+        self._sleep = asyncio.sleep
+
+        async def no_backoff(delay, *a, **k):
+            await self._sleep(0)
+
+        p = mock.patch.object(self.idx.asyncio, "sleep", no_backoff)
+        p.start()
+        self.addCleanup(p.stop)
+        p = mock.patch.object(self.idx, "tqdm", functools.partial(self.idx.tqdm, disable=True))
+        p.start()
+        self.addCleanup(p.stop)
+
+    def _client(self, handler):
+        import httpx
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def test_transport_errors_are_retried(self) -> None:
+        import httpx
+        calls = []
+
+        def handler(request):
+            calls.append(1)
+            if len(calls) < 3:
+                raise httpx.ConnectTimeout("timed out", request=request)
+            return httpx.Response(200, json={"ok": True})
+
+        async def go():
+            async with self._client(handler) as client:
+                return await self.idx._post_with_retry(client, "https://x.invalid/", {}, b"{}")
+
+        self.assertEqual(asyncio.run(go()).status_code, 200)
+        self.assertEqual(len(calls), 3)
+
+    def test_transport_error_raises_after_last_attempt(self) -> None:
+        import httpx
+
+        def handler(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        async def go():
+            async with self._client(handler) as client:
+                await self.idx._post_with_retry(client, "https://x.invalid/", {}, b"{}")
+
+        with self.assertRaises(httpx.ReadTimeout):
+            asyncio.run(go())
+
+    def test_embed_failure_cancels_sibling_chunks(self) -> None:
+        import httpx
+        finished = []
+
+        async def handler(request):
+            texts = orjson.loads(request.content)["input"]
+            if texts[0].startswith("bad"):
+                return httpx.Response(400, text="bad input")
+            await self._sleep(0.05)
+            finished.append(texts[0])
+            return httpx.Response(200, json={"data": [{"embedding": [0.0]} for _ in texts]})
+
+        kb = [{"id": "0", "title": "bad"}] + [{"id": str(i), "title": f"t{i}"} for i in range(1, 4)]
+
+        async def go():
+            async with self._client(handler) as client:
+                with self.assertRaisesRegex(RuntimeError, "Embedding failed"):
+                    await self.idx.upsert_docs_async(self.idx.embed_docs(client, kb, chunk=1),
+                                                     client=client, total=len(kb))
+                # Give any surviving sibling requests time to finish
+                await self._sleep(0.2)
+
+        asyncio.run(go())
+        self.assertEqual(finished, [])
+
+    def test_upsert_failure_cancels_pending_upserts(self) -> None:
+        import httpx
+        finished = []
+
+        async def handler(request):
+            if "/embeddings" in request.url.path:
+                n = len(orjson.loads(request.content)["input"])
+                return httpx.Response(200, json={"data": [{"embedding": [0.0]} for _ in range(n)]})
+            ids = [d["id"] for d in orjson.loads(request.content)["value"]]
+            if ids == ["0"]:
+                return httpx.Response(400, text="bad doc")
+            await self._sleep(0.05)
+            finished.append(ids)
+            return httpx.Response(200)
+
+        docs = [{"id": str(i)} for i in range(4)]
+
+        async def go():
+            async with self._client(handler) as client:
+                with self.assertRaisesRegex(RuntimeError, "Upsert failed"):
+                    await self.idx.upsert_docs_async(docs, batch_size=1, client=client)
+                await self._sleep(0.2)
+
+        asyncio.run(go())
+        self.assertEqual(finished, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""pull_from_inbox keeps sms_records sorted by receive time."""
+
+import unittest
+from unittest import mock
+
+import orjson
+
+from tests._query import HAS_STREAMLIT, SessionState, load_query
+
+
+class _Resp:
+    def __init__(self, rows):
+        self.content = orjson.dumps(rows)
+
+    def raise_for_status(self):
+        pass
+
+
+@unittest.skipUnless(HAS_STREAMLIT, "streamlit not installed")
+class PullFromInboxTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.q = load_query()
+
+    def pull(self, state, rows):
+        q = self.q
+        toasts = []
+        fake_st = mock.Mock(session_state=state, toast=lambda *a, **k: toasts.append(a))
+        with mock.patch.object(q, "st", fake_st), \
+                mock.patch.object(q, "fetch_notify_config", lambda base: ""), \
+                mock.patch.object(q._HTTP, "get", lambda *a, **k: _Resp(rows)):
+            n = q.pull_from_inbox()
+        self.assertEqual(toasts, [])
+        return n
+
+    def test_new_rows_are_inserted_in_time_order(self):
+        state = SessionState(sms_records=[], last_seen_id=0)
+        rows = [
+            {"id": 2, "message": "b", "received_at": "2025-09-15T04:00:02Z"},
+            {"id": 1, "message": "c", "received_at": "2025-09-15T04:00:03Z"},
+            {"id": 3, "message": "a", "received_at": "2025-09-15T04:00:01Z"},
+        ]
+        self.assertEqual(self.pull(state, rows), 3)
+        self.assertEqual([r["message"] for r in state.sms_records], ["a", "b", "c"])
+        self.assertEqual(state.last_seen_id, 3)
+
+    def test_legacy_records_without_sort_key(self):
+        # Records carried over from an older session have no _ts_ns (or a stale _dt)
+        state = SessionState(
+            sms_records=[
+                {"message": "old1", "received_at": "2025-09-15T04:00:01Z", "_dt": None},
+                {"message": "old3", "received_at": "2025-09-15T04:00:03Z"},
+            ],
+            last_seen_id=0,
+        )
+        rows = [{"id": 7, "message": "new2", "received_at": "2025-09-15T04:00:02Z"}]
+        self.assertEqual(self.pull(state, rows), 1)
+        self.assertEqual([r["message"] for r in state.sms_records], ["old1", "new2", "old3"])
+        self.assertTrue(all("_ts_ns" in r and "_dt" not in r for r in state.sms_records))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+"""get_store raises on a failed open, so cache_resource never memoises None."""
+
+import unittest
+from unittest import mock
+
+from tests._query import HAS_STREAMLIT, load_query
+
+
+@unittest.skipUnless(HAS_STREAMLIT, "streamlit not installed")
+class GetStoreTest(unittest.TestCase):
+    # Outside a script run cache_resource always recomputes, so this checks what
+    # the cached function returns or raises; the memoisation itself is Streamlit's.
+    def test_failed_open_raises_and_success_returns_store(self):
+        q = load_query()
+        self.addCleanup(q.get_store.clear)
+        store = object()
+        with mock.patch.object(q, "build_store_from_env", return_value=None):
+            with self.assertRaises(RuntimeError):
+                q.get_store()
+        with mock.patch.object(q, "build_store_from_env", return_value=store):
+            self.assertIs(q.get_store(), store)
+
+
+if __name__ == "__main__":
+    unittest.main()
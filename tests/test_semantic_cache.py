@@ -0,0 +1,68 @@
+"""SemanticCache: threshold, namespace isolation and reuse, TTL, FIFO eviction."""
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+
+def _vec(*xs):
+    return np.asarray(xs, dtype=np.float32)
+
+
+class SemanticCacheTest(unittest.TestCase):
+    def test_hit_above_threshold_only(self) -> None:
+        c = SemanticCache(capacity=4, threshold=0.9)
+        c.put("a", _vec(1, 0, 0), "x")
+        self.assertEqual(c.get("a", _vec(2, 0.1, 0)), "x")  # scale-invariant, cos ~ 0.999
+        self.assertIsNone(c.get("a", _vec(0, 1, 0)))
+
+    def test_namespaces_do_not_cross(self) -> None:
+        c = SemanticCache(capacity=4)
+        c.put("a", _vec(1, 0, 0), "for a")
+        self.assertIsNone(c.get("b", _vec(1, 0, 0)))
+        c.put("b", _vec(1, 0, 0), "for b")
+        self.assertEqual(c.get("a", _vec(1, 0, 0)), "for a")
+        self.assertEqual(c.get("b", _vec(1, 0, 0)), "for b")
+
+    def test_namespace_released_with_last_row_and_id_reused(self) -> None:
+        c = SemanticCache(capacity=2)
+        c.put("a", _vec(1, 0, 0), "a1")
+        c.put("b", _vec(0, 1, 0), "b1")
+        nid_a = c._ns_map["a"]
+        c.put("c", _vec(1, 0, 0), "c1")  # overwrites a's only row
+        self.assertNotIn("a", c._ns_map)
+        self.assertEqual(c._ns_map["c"], nid_a)
+        self.assertIsNone(c.get("a", _vec(1, 0, 0)))
+        self.assertEqual(c.get("c", _vec(1, 0, 0)), "c1")
+        self.assertEqual(c.get("b", _vec(0, 1, 0)), "b1")
+        # Many distinct namespaces never grow the map past capacity
+        for i in range(50):
+            c.put(f"n{i}", _vec(1, i, 0), i)
+        self.assertLessEqual(len(c._ns_map), 2)
+        self.assertEqual(sorted(c._ns_rows.values()), [1, 1])
+
+    def test_entries_expire_after_ttl(self) -> None:
+        now = [1000.0]
+        with mock.patch.object(semantic_cache.time, "monotonic", lambda: now[0]):
+            c = SemanticCache(capacity=4, ttl_s=10.0)
+            c.put("a", _vec(1, 0, 0), "x")
+            now[0] += 9.0
+            self.assertEqual(c.get("a", _vec(1, 0, 0)), "x")
+            now[0] += 2.0
+            self.assertIsNone(c.get("a", _vec(1, 0, 0)))
+
+    def test_dimension_change_resets(self) -> None:
+        c = SemanticCache(capacity=4, dtype=np.float16)
+        c.put("a", _vec(1, 0, 0), "x")
+        self.assertIsNone(c.get("a", _vec(1, 0, 0, 0)))
+        c.put("a", _vec(1, 0, 0, 0), "y")
+        self.assertEqual(c.get("a", _vec(1, 0, 0, 0)), "y")
+        self.assertIsNone(c.get("a", _vec(1, 0, 0)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""topk_cos: numba kernels agree with the NumPy fallback; fallback when numba is absent."""
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import semantic_cache_jit
+from semantic_cache_jit import MASKED_SCORE, topk_cos
+
+
+def _unit_rows(rng: np.random.Generator, n: int, d: int) -> np.ndarray:
+    m = rng.standard_normal((n, d)).astype(np.float32)
+    return m / np.linalg.norm(m, axis=1, keepdims=True)
+
+
+class TopKTest(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(7)
+        self.mat = _unit_rows(rng, 50, 16)
+        self.q = _unit_rows(rng, 1, 16)[0]
+        self.valid = np.ones(50, dtype=np.bool_)
+        self.valid[::5] = False
+
+    def _expected(self, mat: np.ndarray, k: int):
+        scores = np.where(self.valid, mat.astype(np.float32) @ self.q, MASKED_SCORE)
+        order = np.argsort(-scores, kind="stable")[:k]
+        return order, scores[order]
+
+    def _check(self, mat: np.ndarray, k: int) -> None:
+        idx, val = topk_cos(mat, self.q, self.valid, k=k)
+        exp_idx, exp_val = self._expected(mat, k)
+        self.assertEqual(list(idx), list(exp_idx))
+        np.testing.assert_allclose(val, exp_val, rtol=1e-4, atol=1e-5)
+        self.assertTrue(all(self.valid[i] for i in idx))
+
+    def test_float32_and_float16(self) -> None:
+        for k in (1, 3):
+            self._check(self.mat, k)
+            self._check(self.mat.astype(np.float16), k)
+
+    def test_numpy_fallback_without_numba(self) -> None:
+        with mock.patch.object(semantic_cache_jit, "_get_kernels", return_value=None):
+            self._check(self.mat, 3)
+            self._check(self.mat.astype(np.float16), 1)
+            self.assertFalse(semantic_cache_jit.warmup())
+
+    def test_kernel_failure_falls_back(self) -> None:
+        def boom(*_args):
+            raise RuntimeError("launch failed")
+        with mock.patch.object(semantic_cache_jit, "_get_kernels", return_value=(boom, boom)):
+            self._check(self.mat, 2)
+
+    def test_warmup_matches_numba_availability(self) -> None:
+        try:
+            import numba  # noqa: F401
+            has_numba = True
+        except ImportError:
+            has_numba = False
+        self.assertEqual(semantic_cache_jit.warmup(), has_numba)
+
+
+if __name__ == "__main__":
+    unittest.main()
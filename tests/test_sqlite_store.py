@@ -0,0 +1,176 @@
+"""Regression tests for SQLiteStore: migration, paging, group commit, read pool."""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import sqlite_store
+from sqlite_store import SQLiteStore
+
+# Schema as created by the original store (before ts_ms, BLOB columns and STRICT)
+_BASELINE_DDL = """
+CREATE TABLE analysis (
+  id TEXT PRIMARY KEY, sms TEXT, normalized TEXT, hits TEXT, context TEXT, answer TEXT, ts TEXT NOT NULL
+);
+CREATE INDEX idx_analysis_ts ON analysis(ts);
+CREATE TABLE sms (
+  id INTEGER PRIMARY KEY AUTOINCREMENT, id_num INTEGER UNIQUE, message TEXT, sender TEXT,
+  receiver TEXT, provider_message_id TEXT, received_at TEXT, created_at TEXT
+);
+CREATE INDEX idx_sms_idnum ON sms(id_num);
+CREATE INDEX idx_sms_recv ON sms(received_at);
+"""
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, "app.db")
+
+    def tearDown(self) -> None:
+        self._tmp.cleanup()
+
+    def open_store(self, readers: int = 2) -> SQLiteStore:
+        with mock.patch.dict(os.environ, {"SQLITE_READERS": str(readers)}):
+            store = SQLiteStore(self.path)
+        self.addCleanup(store.flush)
+        return store
+
+
+class MigrationTest(StoreTestCase):
+    def test_baseline_schema_is_migrated(self) -> None:
+        conn = sqlite3.connect(self.path)
+        conn.executescript(_BASELINE_DDL)
+        conn.execute(
+            "INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ("a1", "msg", '{"error_code": "E1"}', "null", None, "ans", "2025-09-15T04:23:29.733000+00:00"),
+        )
+        conn.execute(
+            "INSERT INTO sms (id_num, message, sender, receiver, provider_message_id, received_at, created_at)"
+            " VALUES (1, 'hello', 's', 'r', 'p', '2025-09-15T04:23:29Z', '2025-09-15T04:23:29Z')"
+        )
+        conn.commit()
+        conn.close()
+
+        store = self.open_store()
+        self.assertEqual(store.count_analysis(), 1)
+        items, _ = store.get_analysis_seek(None, 10)
+        self.assertEqual(items[0]["id"], "a1")
+        self.assertEqual(items[0]["normalized"], {"error_code": "E1"})
+        self.assertIsNone(items[0]["hits"])
+        self.assertEqual(store.get_sms_recent(0, 10)[0]["message"], "hello")
+
+        row = store._rw.execute("SELECT ts_ms, typeof(normalized) FROM analysis").fetchone()
+        self.assertEqual(row, (1757910209733, "blob"))
+        self.assertEqual(store._rw.execute("PRAGMA user_version").fetchone()[0], sqlite_store._SCHEMA_VERSION)
+        indexes = {r[0] for r in store._rw.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertIn("idx_analysis_ts_ms", indexes)
+        self.assertIn("idx_sms_cover", indexes)
+        self.assertFalse(indexes & {"idx_analysis_ts", "idx_sms_idnum", "idx_sms_recv"})
+
+        # Counter triggers exist on the rebuilt table
+        store.save_analysis({"id": "a2", "ts": "2025-09-16 00:00:00"})
+        self.assertEqual(store.count_analysis(), 2)
+
+    def test_reopen_skips_schema_setup(self) -> None:
+        self.open_store()
+        with mock.patch.object(SQLiteStore, "_migrate_schema") as migrate:
+            self.open_store()
+        migrate.assert_not_called()
+
+
+class PagingTest(StoreTestCase):
+    def test_keyset_pages_match_offset_pages(self) -> None:
+        store = self.open_store()
+        # Repeated timestamps exercise the id tie-break
+        for i in range(23):
+            store.save_analysis({"id": f"r{i:02d}", "ts": f"2025-09-15 00:00:{i // 3:02d}"}, wait=False)
+        store.flush()
+
+        cursor, page = None, 1
+        while True:
+            seek, cursor = store.get_analysis_seek(cursor, 5)
+            offset, total = store.get_analysis_page(page, 5)
+            self.assertEqual([r["id"] for r in seek], [r["id"] for r in offset])
+            self.assertEqual([r["id"] for r in store.iter_analysis_page(page, 5)], [r["id"] for r in offset])
+            self.assertEqual(total, 23)
+            if cursor is None:
+                break
+            page += 1
+        self.assertEqual(page, 5)
+
+
+class FlusherTest(StoreTestCase):
+    def test_bad_write_does_not_sink_its_batch(self) -> None:
+        store = self.open_store()
+        # Park the flusher on the writer lock behind a first write, so the next three
+        # queue up and are applied as one group commit once the lock is released
+        with store._write_lock:
+            store.save_analysis({"id": "good0", "ts": "2025-09-15 00:00:00"}, wait=False)
+            time.sleep(0.1)
+            store.save_analysis({"id": "good1", "ts": "2025-09-15 00:00:01"}, wait=False)
+            bad = threading.Thread(target=self._expect_failure, args=(store,))
+            bad.start()
+            time.sleep(0.1)
+            store.save_analysis({"id": "good2", "ts": "2025-09-15 00:00:02"}, wait=False)
+        bad.join(5)
+        self.assertFalse(bad.is_alive())
+        store.flush()
+        self.assertEqual({r["id"] for r in store.get_analysis_page(1, 10)[0]}, {"good0", "good1", "good2"})
+        self.assertEqual(store.count_analysis(), 3)
+
+    def _expect_failure(self, store: SQLiteStore) -> None:
+        # ts is NOT NULL
+        with self.assertRaises(sqlite3.IntegrityError):
+            store.save_analysis({"id": "bad", "ts": None})
+
+
+class ReadPoolTest(StoreTestCase):
+    def _add_sms(self, store: SQLiteStore, n: int) -> None:
+        store.add_sms_many([(i, {"message": f"m{i}"}) for i in range(1, n + 1)])
+
+    def test_open_generator_does_not_block_writes(self) -> None:
+        # With no readers, reads go through the writer under its lock
+        store = self.open_store(readers=0)
+        self._add_sms(store, sqlite_store._FETCH_BATCH * 2 + 5)
+        rows = store.iter_sms_recent(0, 500)
+        next(rows)
+
+        done = threading.Event()
+        threading.Thread(target=lambda: (store.add_sms(10_000, {"message": "late"}), done.set()), daemon=True).start()
+        finished = done.wait(5)
+        rest = list(rows)  # exhausting the generator releases anything it still holds
+        self.assertTrue(finished, "write blocked by an open generator")
+        self.assertEqual(len(rest), sqlite_store._FETCH_BATCH * 2 + 5)
+        self.assertEqual(rest[-1]["id"], 10_000)
+
+    def test_open_generators_do_not_exhaust_the_pool(self) -> None:
+        store = self.open_store(readers=1)
+        self._add_sms(store, 10)
+        held = [store.iter_sms_recent(0, 10) for _ in range(3)]
+        for g in held:
+            next(g)
+        self.assertEqual(store._readers.qsize(), 1)
+        got = []
+        reader = threading.Thread(target=lambda: got.append(store.get_sms_recent(0, 10)), daemon=True)
+        reader.start()
+        reader.join(5)
+        self.assertEqual([len(r) for r in got], [10])
+
+    def test_read_falls_back_to_writer_when_pool_is_busy(self) -> None:
+        store = self.open_store(readers=1)
+        self._add_sms(store, 3)
+        conn = store._readers.get()
+        try:
+            with mock.patch.object(sqlite_store, "_READER_WAIT_S", 0.05):
+                self.assertEqual(len(store.get_sms_recent(0, 10)), 3)
+        finally:
+            store._readers.put(conn)
+
+
+if __name__ == "__main__":
+    unittest.main()